@@ -25,7 +25,7 @@ setup(
     author_email='ruslan.spivak@gmail.com',
     packages=find_packages('src'),
     package_dir={'': 'src'},
-    install_requires=['setuptools>=0.7', 'paramiko'],
+    install_requires=['setuptools>=0.7', 'paramiko>=3.3'],
     zip_safe=False,
     entry_points="""\
     [console_scripts]
@@ -33,5 +33,5 @@ setup(
     """,
     classifiers=filter(None, classifiers.split('\n')),
     long_description=read('README.rst'),
-    extras_require={'test': []}
+    extras_require={'test': [], 'crc32c': ['crc32c']}
     )
@@ -0,0 +1 @@
+"""Make ``sftpserver`` and ``helper`` importable by the tests in ``test/``."""
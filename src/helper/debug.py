@@ -1,48 +1,16 @@
-from functools import wraps
-from time import time
 from typing import Callable
 
-from .logger import logger
-
-func_debug_cnt = 0
+from .tracing import traced
 
 
 def function_debuger(print_input=False, print_output=False, limit_input=200):
-    def decorator_debuger(func):
-        def wrapper(*args, **kwargs):
-            global func_debug_cnt
-            now = time()
-            if len(args) > 0 and isinstance(args[0], object):
-                debug_info = f"{args[0].__class__.__name__} {func.__name__}"
-            else:
-                debug_info = func.__name__
-            logger.debug("  " * func_debug_cnt + f">> {debug_info}")
-            func_debug_cnt += 1
-            try:
-                if print_input:
-                    logger.debug(
-                        "  " * func_debug_cnt + f"-> {args} {kwargs}"[:limit_input]
-                    )
-                result = func(*args, **kwargs)
-                if print_output:
-                    logger.debug("  " * func_debug_cnt + f"<- {result}")
-            except Exception as e:
-                raise e
-            finally:
-                func_debug_cnt -= 1
-            logger.debug(
-                "  " * func_debug_cnt + f"<< {debug_info} %.2fs" % (time() - now)
-            )
-            return result
-
-        return wrapper
+    """Trace calls of the decorated function, see :mod:`helper.tracing`.
 
+    Usable bare (``@function_debuger``) or with arguments.
+    """
     if isinstance(print_input, Callable):
-        logger.debug("print_input -------_> %r", print_input)
-        func = print_input
-        print_input = False
-        return decorator_debuger(func)
-    return decorator_debuger
+        return traced()(print_input)
+    return traced(dump_input=print_input, dump_output=print_output, limit=limit_input)
 
 
 def function_debuger_with_resule(func):
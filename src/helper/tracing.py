@@ -0,0 +1,83 @@
+"""
+Call tracing for SFTP operations and S3 calls.
+
+Tracing is off unless ``SFTP_TRACE`` is set, and then traced functions
+are returned undecorated: the hot read/write path pays nothing.  When it
+is on, every call is a span logged at DEBUG with its elapsed time,
+indented by its nesting depth.  The depth lives in a ``ContextVar`` so
+concurrent sessions do not mix up each other's nesting.  Arguments and
+results are only dumped for a sampled ``SFTP_TRACE_SAMPLE`` fraction of
+calls.
+"""
+
+import contextvars
+import logging
+import os
+import random
+from functools import wraps
+from time import perf_counter
+
+from .logger import logger
+
+ENABLED = os.getenv("SFTP_TRACE", "").lower() in ("1", "true", "yes", "on")
+SAMPLE_RATE = float(os.getenv("SFTP_TRACE_SAMPLE", "0.01"))
+
+_depth = contextvars.ContextVar("trace_depth", default=0)
+
+
+class span(object):
+    """Log entering and leaving ``name`` with the time spent inside."""
+
+    __slots__ = ("name", "depth", "start", "_token")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.depth = _depth.get()
+        logger.debug("%s>> %s", "  " * self.depth, self.name)
+        self._token = _depth.set(self.depth + 1)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = perf_counter() - self.start
+        _depth.reset(self._token)
+        logger.debug(
+            "%s<< %s %.4fs%s",
+            "  " * self.depth,
+            self.name,
+            elapsed,
+            " !! %s" % exc_type.__name__ if exc_type else "",
+        )
+
+    def dump(self, prefix, value, limit=None):
+        text = "%s %r" % (prefix, value)
+        logger.debug("%s%s", "  " * (self.depth + 1), text[:limit])
+
+
+def traced(name=None, dump_input=False, dump_output=False, limit=200):
+    """Decorate a function so that each call is a :class:`span`."""
+
+    def decorator(func):
+        if not ENABLED:
+            return func
+        label = name or func.__qualname__
+        dump = dump_input or dump_output
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not logger.isEnabledFor(logging.DEBUG):
+                return func(*args, **kwargs)
+            sampled = dump and random.random() < SAMPLE_RATE
+            with span(label) as current:
+                if sampled and dump_input:
+                    current.dump("->", (args, kwargs), limit)
+                result = func(*args, **kwargs)
+                if sampled and dump_output:
+                    current.dump("<-", result, limit)
+                return result
+
+        return wrapper
+
+    return decorator
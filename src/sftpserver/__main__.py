@@ -25,44 +25,107 @@
 __author__ = "Ruslan Spivak <ruslan.spivak@gmail.com>"
 
 import argparse
-import socket
-import sys
+import configparser
 import textwrap
-import time
 
 import paramiko
 
-from sftpserver.stub_sftp import StubServer, StubSFTPServer
+from sftpserver import metrics, settings
+from sftpserver.server import (
+    SessionServer,
+    TransportOptions,
+    create_server_socket,
+    load_host_keys,
+)
+from sftpserver.supervisor import Supervisor
 
 HOST, PORT = "0.0.0.0", 3377
-BACKLOG = 10
+KEYFILE = "/home/sihc/.ssh/id_rsa"
 
+# Section of the --config file holding option defaults.
+CONFIG_SECTION = "sftpserver"
 
-def start_server(host, port, keyfile, level):
+
+def start_server(
+    host,
+    port,
+    keyfiles,
+    level,
+    max_sessions=None,
+    workers=0,
+    metrics_host=None,
+    metrics_port=0,
+    options=None,
+):
     paramiko_level = getattr(paramiko.common, level)
     paramiko.common.logging.basicConfig(level=paramiko_level)
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-    server_socket.bind((host, port))
-    server_socket.listen(BACKLOG)
+    if isinstance(keyfiles, str):
+        keyfiles = [keyfiles]
+    host_keys = load_host_keys(keyfiles)
+    server_socket = create_server_socket(host, port)
+    metrics_address = None
+    if metrics_port:
+        metrics_address = (metrics_host or settings.METRICS_HOST, metrics_port)
+    if workers > 0:
+        try:
+            Supervisor(
+                server_socket,
+                host_keys,
+                workers,
+                max_sessions,
+                metrics_address,
+                options,
+            ).run()
+        finally:
+            server_socket.close()
+        return
+
+    if metrics_address is not None:
+        metrics.start_metrics_server(*metrics_address)
 
-    while True:
-        print("Connecting")
-        conn, addr = server_socket.accept()
+    server = SessionServer(
+        server_socket, host_keys, max_sessions=max_sessions, options=options
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_socket.close()
+        server.shutdown(settings.DRAIN_TIMEOUT)
 
-        host_key = paramiko.RSAKey.from_private_key_file(keyfile, password="s")
-        transport = paramiko.Transport(conn)
-        transport.add_server_key(host_key)
-        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, StubSFTPServer)
 
-        server = StubServer()
-        transport.start_server(server=server)
+def apply_config(parser, args, path):
+    """Take the options not given on the command line from an INI file.
 
-        print("Waiting for connection")
-        channel = transport.accept()
-        while transport.is_active():
-            time.sleep(1)
+    Keys of its ``[sftpserver]`` section are long option names, such as
+    ``window-size = 33554432``; ``keyfile`` takes several paths separated
+    by commas.
+    """
+    config = configparser.ConfigParser()
+    try:
+        with open(path) as f:
+            config.read_file(f)
+    except (OSError, configparser.Error) as e:
+        parser.error("cannot read config file %s: %s" % (path, e))
+    if not config.has_section(CONFIG_SECTION):
+        return
+    actions = {action.dest: action for action in parser._actions}
+    for name, value in config.items(CONFIG_SECTION):
+        action = actions.get(name.replace("-", "_"))
+        if action is None or action.dest in ("help", "config"):
+            parser.error("unknown option %r in %s" % (name, path))
+        if getattr(args, action.dest) != action.default:
+            continue  # The command line wins.
+        try:
+            if isinstance(action, argparse._AppendAction):
+                value = [item.strip() for item in value.split(",") if item.strip()]
+            elif action.type is not None:
+                value = action.type(value)
+        except ValueError:
+            parser.error("invalid value for %r in %s: %r" % (name, path, value))
+        setattr(args, action.dest, value)
 
 
 def main():
@@ -92,22 +155,111 @@ def main():
         default="DEBUG",
         help="Debug level: WARNING, INFO, DEBUG [default: %(default)s]",
     )
+    parser.add_argument(
+        "-c",
+        "--config",
+        dest="config",
+        metavar="FILE",
+        help="read option defaults from the [%s] section of this INI file"
+        % CONFIG_SECTION,
+    )
     parser.add_argument(
         "-k",
         "--keyfile",
         dest="keyfile",
-        default="/home/sihc/.ssh/id_rsa",
+        action="append",
         metavar="FILE",
-        help="Path to private key, for example /tmp/test_rsa.key",
+        help="Path to a private host key (Ed25519, ECDSA or RSA), for example "
+        "/tmp/test_rsa.key; repeat it to offer keys of several types "
+        "[default: %s]" % KEYFILE,
+    )
+    parser.add_argument(
+        "--max-sessions",
+        dest="max_sessions",
+        type=int,
+        default=settings.MAX_SESSIONS,
+        help="serve at most N sessions at once [default: %(default)d]",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=settings.WORKERS,
+        help="pre-fork N worker processes sharing the port, 0 serves "
+        "from a single process [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        dest="metrics_host",
+        default=settings.METRICS_HOST,
+        help="serve Prometheus metrics on HOST [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        default=settings.METRICS_PORT,
+        help="serve Prometheus metrics on PORT, workers use PORT + their "
+        "index, 0 disables it [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--ciphers",
+        dest="ciphers",
+        default=settings.SSH_CIPHERS,
+        help="SSH ciphers offered, comma separated, fastest first "
+        "[default: %(default)s]",
+    )
+    parser.add_argument(
+        "--macs",
+        dest="macs",
+        default=settings.SSH_MACS,
+        help="SSH MACs offered, comma separated [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--kex",
+        dest="kex",
+        default=settings.SSH_KEX,
+        help="SSH key exchanges offered, comma separated, empty for all",
+    )
+    parser.add_argument(
+        "--window-size",
+        dest="window_size",
+        type=int,
+        default=settings.SSH_WINDOW_SIZE,
+        help="SSH channel window in bytes, uploads get at most this much "
+        "per round trip [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--max-packet-size",
+        dest="max_packet_size",
+        type=int,
+        default=settings.SSH_MAX_PACKET_SIZE,
+        help="largest SSH packet accepted, in bytes [default: %(default)d]",
     )
 
     args = parser.parse_args()
+    if args.config:
+        apply_config(parser, args, args.config)
 
-    if args.keyfile is None:
-        parser.print_help()
-        sys.exit(-1)
+    try:
+        options = TransportOptions(
+            args.ciphers, args.macs, args.kex, args.window_size, args.max_packet_size
+        )
+    except ValueError as e:
+        parser.error(str(e))
 
-    start_server(args.host, args.port, args.keyfile, args.level)
+    start_server(
+        args.host,
+        args.port,
+        args.keyfile or settings.HOST_KEYS or [KEYFILE],
+        args.level,
+        args.max_sessions,
+        args.workers,
+        args.metrics_host,
+        args.metrics_port,
+        options,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,467 @@
+"""
+Reproducible benchmarks against a local S3 stand-in.
+
+The server is started through its ``python -m sftpserver`` entry point,
+pointed at a :class:`~sftpserver.fake_s3.FakeS3Server` running in this
+process, and driven with a paramiko client::
+
+    python -m sftpserver.benchmark --output before.json
+    # ... change something ...
+    python -m sftpserver.benchmark --baseline before.json
+
+``--latency`` puts a proxy adding a round-trip delay between the client
+and the server, which shows how SSH window sizes bound the throughput
+of long-haul links::
+
+    python -m sftpserver.benchmark --latency 50 -- --window-size 2097152
+
+Every result is a single number with its unit and whether higher or
+lower is better, so runs can be saved as JSON and compared; a result
+worse than the baseline by more than ``--tolerance`` is reported as a
+regression and makes the command exit with status 1.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from .fake_s3 import FakeS3Server
+
+BUCKET = "bench"
+MB = 1024 * 1024
+
+# name: (file size, number of files)
+TRANSFERS = {
+    "small": (64 * 1024, 64),
+    "medium": (8 * MB, 4),
+    "large": (64 * MB, 1),
+}
+LISTING_SIZES = (10, 10000, 100000)
+STAT_FILES = 500
+HANDSHAKES = 20
+REPEAT = 3
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_host_key(path, key_type):
+    """Generate a host key of ``key_type`` (rsa, ecdsa or ed25519)."""
+    if key_type == "ed25519":
+        # paramiko cannot generate Ed25519 keys.
+        key = ed25519.Ed25519PrivateKey.generate()
+        with open(path, "wb") as f:
+            f.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.OpenSSH,
+                    serialization.NoEncryption(),
+                )
+            )
+    elif key_type == "ecdsa":
+        paramiko.ECDSAKey.generate().write_private_key_file(path, password="s")
+    else:
+        paramiko.RSAKey.generate(2048).write_private_key_file(path, password="s")
+
+
+class LatencyProxy(object):
+    """Forward local TCP connections to ``port``, ``latency`` seconds of
+    round trip later, like a long-haul link with unlimited bandwidth."""
+
+    def __init__(self, port, latency):
+        self.target = ("127.0.0.1", port)
+        self.delay = latency / 2.0
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for sockets in ((client, upstream), (upstream, client)):
+                pending = queue.Queue()
+                threading.Thread(
+                    target=self._receive, args=(sockets[0], pending), daemon=True
+                ).start()
+                threading.Thread(
+                    target=self._send, args=(sockets[1], pending), daemon=True
+                ).start()
+
+    def _receive(self, source, pending):
+        while True:
+            try:
+                data = source.recv(256 * 1024)
+            except OSError:
+                data = b""
+            pending.put((time.monotonic() + self.delay, data))
+            if not data:
+                return
+
+    def _send(self, sink, pending):
+        while True:
+            due, data = pending.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    sink.shutdown(socket.SHUT_WR)
+                    return
+                sink.sendall(data)
+            except OSError:
+                return
+
+    def stop(self):
+        self.listener.close()
+
+
+class ServerProcess(object):
+    """``python -m sftpserver`` on a free local port, using ``fake``.
+
+    Clients connect through a :class:`LatencyProxy` when ``latency``
+    (seconds) is set, with an SSH window of ``client_window`` bytes.
+    """
+
+    def __init__(
+        self,
+        fake,
+        workdir,
+        args=(),
+        env=None,
+        log=None,
+        host_key="rsa",
+        latency=0,
+        client_window=None,
+    ):
+        self.port = free_port()
+        self.client_port = self.port
+        self.proxy = None
+        self.latency = latency
+        self.client_window = client_window or paramiko.common.DEFAULT_WINDOW_SIZE
+        keyfile = os.path.join(workdir, "host-%s.key" % host_key)
+        if not os.path.exists(keyfile):
+            write_host_key(keyfile, host_key)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environ = dict(os.environ)
+        environ.update(
+            PYTHONPATH=os.pathsep.join(
+                filter(None, [package_root, environ.get("PYTHONPATH")])
+            ),
+            AWS_ACCESS_KEY_ID="bench",
+            AWS_SECRET_KEY_ID="bench",
+            S3_HOST=fake.host,
+            S3_PORT=str(fake.port),
+            S3_SECURE="0",
+        )
+        environ.update(env or {})
+        command = [sys.executable, "-m", "sftpserver", "--host", "127.0.0.1"]
+        command += ["-p", str(self.port), "-k", keyfile, "-l", "WARNING"]
+        self.process = subprocess.Popen(
+            command + list(args),
+            env=environ,
+            stdout=log or subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout=15):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("sftpserver exited with %d" % self.process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+            except OSError:
+                time.sleep(0.1)
+                continue
+            if self.latency:
+                self.proxy = LatencyProxy(self.port, self.latency)
+                self.client_port = self.proxy.port
+            return self
+        raise RuntimeError("sftpserver did not start listening in time")
+
+    def client(self):
+        transport = paramiko.Transport(
+            ("127.0.0.1", self.client_port),
+            default_window_size=self.client_window,
+        )
+        transport.connect(username="bench", password="bench")
+        return transport, paramiko.SFTPClient.from_transport(transport)
+
+    def stop(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def result(value, unit, better):
+    return {"value": round(value, 6), "unit": unit, "better": better}
+
+
+def bench_transfers(sftp, transfers):
+    results = {}
+    for name, (size, count) in transfers.items():
+        payload = os.urandom(size)
+        paths = ["/%s/%s/%d.bin" % (BUCKET, name, i) for i in range(count)]
+        start = time.perf_counter()
+        for path in paths:
+            sftp.putfo(io.BytesIO(payload), path, size, confirm=False)
+        elapsed = time.perf_counter() - start
+        results["upload_%s" % name] = result(size * count / MB / elapsed, "MB/s", "higher")
+
+        start = time.perf_counter()
+        for path in paths:
+            sink = io.BytesIO()
+            sftp.getfo(path, sink)
+            if sink.getbuffer().nbytes != size:
+                raise RuntimeError("short download of %s" % path)
+        elapsed = time.perf_counter() - start
+        results["download_%s" % name] = result(
+            size * count / MB / elapsed, "MB/s", "higher"
+        )
+    return results
+
+
+def bench_listings(server, fake, sizes, repeat):
+    results = {}
+    for size in sizes:
+        directory = "ls%d" % size
+        for i in range(size):
+            fake.put_object(BUCKET, "%s/%08d" % (directory, i), b"")
+        timings = []
+        for _ in range(repeat):
+            # Each run in a new session, like a client connecting to
+            # pick up files from a drop folder.
+            transport, sftp = server.client()
+            try:
+                start = time.perf_counter()
+                entries = sftp.listdir_attr("/%s/%s" % (BUCKET, directory))
+                timings.append(time.perf_counter() - start)
+            finally:
+                transport.close()
+            if len(entries) != size:
+                raise RuntimeError("listed %d of %d entries" % (len(entries), size))
+        results["ls_%d" % size] = result(statistics.median(timings), "s", "lower")
+    return results
+
+
+def bench_stats(sftp, fake, count):
+    for i in range(count):
+        fake.put_object(BUCKET, "stat/%06d" % i, b"x")
+        fake.put_object(BUCKET, "statdirs/%06d/" % i, b"")
+    results = {}
+    workloads = (
+        ("stat_file", "/%s/stat/%%06d" % BUCKET),
+        ("stat_file_warm", "/%s/stat/%%06d" % BUCKET),
+        ("stat_dir", "/%s/statdirs/%%06d" % BUCKET),
+        ("stat_missing", "/%s/stat/missing-%%06d" % BUCKET),
+    )
+    for name, pattern in workloads:
+        start = time.perf_counter()
+        for i in range(count):
+            try:
+                sftp.stat(pattern % i)
+            except IOError:
+                if name != "stat_missing":
+                    raise
+        elapsed = time.perf_counter() - start
+        results[name] = result(elapsed / count * 1000, "ms", "lower")
+    return results
+
+
+def bench_handshakes(server, count):
+    """Median time to connect, exchange keys and authenticate."""
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        transport, sftp = server.client()
+        timings.append(time.perf_counter() - start)
+        transport.close()
+    return {"handshake": result(statistics.median(timings) * 1000, "ms", "lower")}
+
+
+def run(args):
+    transfers = dict(TRANSFERS)
+    sizes = LISTING_SIZES
+    stat_files = STAT_FILES
+    if args.quick:
+        transfers = {
+            name: (size // 8, max(1, count // 8))
+            for name, (size, count) in transfers.items()
+        }
+        sizes = tuple(size for size in sizes if size <= 10000)
+        stat_files = 100
+    handshakes = HANDSHAKES // 4 if args.quick else HANDSHAKES
+
+    fake = FakeS3Server().start()
+    fake.create_bucket(BUCKET)
+    with tempfile.TemporaryDirectory() as workdir:
+        server = ServerProcess(
+            fake,
+            workdir,
+            args.server_args,
+            log=args.server_log,
+            host_key=args.host_key,
+            latency=args.latency / 1000.0,
+            client_window=args.client_window,
+        )
+        try:
+            server.wait_ready()
+            results = bench_handshakes(server, handshakes)
+            transport, sftp = server.client()
+            try:
+                results.update(bench_transfers(sftp, transfers))
+            finally:
+                transport.close()
+            results.update(bench_listings(server, fake, sizes, args.repeat))
+            transport, sftp = server.client()
+            try:
+                results.update(bench_stats(sftp, fake, stat_files))
+            finally:
+                transport.close()
+        finally:
+            server.stop()
+            fake.stop()
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+            "server_args": list(args.server_args),
+            "host_key": args.host_key,
+            "latency_ms": args.latency,
+            "client_window": args.client_window,
+            "s3_requests": fake.request_count,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print ``results`` next to ``baseline``, return the regressed names."""
+    regressions = []
+    print("%-20s %14s %14s %9s" % ("benchmark", "baseline", "current", "change"))
+    for name, current in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None or not before["value"]:
+            print("%-20s %14s %11.4f %-2s" % (name, "-", current["value"], current["unit"]))
+            continue
+        change = (current["value"] - before["value"]) / before["value"]
+        worse = -change if current["better"] == "higher" else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            "%-20s %11.4f %-2s %11.4f %-2s %+8.1f%%%s"
+            % (
+                name,
+                before["value"],
+                before["unit"],
+                current["value"],
+                current["unit"],
+                change * 100,
+                flag,
+            )
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sftpserver.benchmark", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "-o", "--output", metavar="FILE", help="write the results as JSON to FILE"
+    )
+    parser.add_argument(
+        "-b", "--baseline", metavar="FILE", help="compare with results saved in FILE"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="relative slowdown reported as a regression [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=REPEAT,
+        help="runs of each listing, the median is kept [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="smaller files and directories"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        metavar="MS",
+        help="round-trip time in milliseconds added between the client and "
+        "the server [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--client-window",
+        type=int,
+        metavar="BYTES",
+        help="SSH window of the benchmark client, which bounds downloads "
+        "[default: paramiko's]",
+    )
+    parser.add_argument(
+        "--host-key",
+        choices=("rsa", "ecdsa", "ed25519"),
+        default="rsa",
+        help="type of the server's host key [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--server-log",
+        type=argparse.FileType("w"),
+        help="write the server's output to this file",
+    )
+    parser.add_argument(
+        "server_args",
+        nargs="*",
+        help="extra sftpserver options, after --",
+    )
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(report["results"], baseline, args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Bulk operations on every key below a prefix.
+
+Keys are deleted with multi-object delete requests of up to
+``DELETE_BATCH`` keys, ``DELETE_CONCURRENCY`` of them in flight, while
+the listing of the prefix is still being paged through.
+"""
+
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from helper.debug import function_debuger
+from helper.logger import logger
+
+from . import settings
+
+# Keys accepted by one batch delete request.
+DELETE_BATCH = 1000
+
+# How many of the failed keys are logged.
+LOGGED_ERRORS = 10
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.DELETE_WORKERS, thread_name_prefix="delete"
+)
+
+
+def iter_keys(storage, bucket_name, prefix):
+    """Yield the ``ObjectInfo`` of every key below ``prefix``, page by page."""
+    marker = ""
+    while True:
+        page = storage.list(bucket_name, prefix=prefix, marker=marker)
+        for info in page.entries:
+            yield info
+        if page.next_marker is None:
+            return
+        marker = page.next_marker
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parent_prefixes(key_name, prefix):
+    """The directory prefixes of ``key_name`` below ``prefix``."""
+    index = key_name.rfind("/", len(prefix), len(key_name) - 1)
+    while index >= len(prefix):
+        yield key_name[: index + 1]
+        index = key_name.rfind("/", len(prefix), index)
+
+
+@function_debuger
+def delete_keys(storage, bucket_name, key_names):
+    """Delete ``key_names`` in parallel batches.
+
+    Returns ``{key: error}`` for the keys that could not be deleted.
+    """
+    slots = threading.BoundedSemaphore(settings.DELETE_CONCURRENCY)
+    errors = {}
+
+    def delete(batch):
+        try:
+            errors.update(storage.delete_many(bucket_name, batch))
+        except OSError as e:
+            errors.update(dict.fromkeys(batch, e.strerror))
+        finally:
+            storage.invalidate_object(bucket_name, *batch)
+            slots.release()
+
+    futures = []
+    for batch in batches(key_names, DELETE_BATCH):
+        slots.acquire()
+        futures.append(_executor.submit(delete, batch))
+    for future in futures:
+        future.result()
+    return errors
+
+
+@function_debuger
+def delete_prefix(storage, bucket_name, prefix):
+    """Delete every key below ``prefix``, which ends with a separator.
+
+    Returns the number of keys deleted and ``{key: error}`` for the
+    others.  Directory markers are deleted last, deepest first, so a
+    backend that keeps real directories finds them empty.
+    """
+    markers = []
+    directories = set([prefix])
+    count = 0
+
+    def files():
+        nonlocal count
+        for info in iter_keys(storage, bucket_name, prefix):
+            directories.update(parent_prefixes(info.name, prefix))
+            if info.name.endswith("/"):
+                markers.append(info.name)
+            else:
+                count += 1
+                yield info.name
+
+    errors = delete_keys(storage, bucket_name, files())
+    markers.sort(reverse=True)
+    for batch in batches(markers, DELETE_BATCH):
+        try:
+            errors.update(storage.delete_many(bucket_name, batch))
+        except OSError as e:
+            errors.update(dict.fromkeys(batch, e.strerror))
+    count += len(markers) - len(errors)
+    storage.invalidate_object(
+        bucket_name,
+        *(name for directory in directories for name in (directory, directory[:-1]))
+    )
+    return count, errors
+
+
+def report_errors(errors, action):
+    """Log a sample of ``errors`` and raise ``EIO`` with their count."""
+    for name, error in sorted(errors.items())[:LOGGED_ERRORS]:
+        logger.error("Could not delete %s: %s", name, error)
+    raise OSError(
+        errno.EIO, "%s: could not delete %d keys" % (action, len(errors))
+    )
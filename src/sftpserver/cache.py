@@ -0,0 +1,254 @@
+"""
+Small thread-safe caches shared by every session of the process.
+"""
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from helper.logger import logger
+
+MISSING = object()
+
+TEMP_SUFFIX = ".tmp"
+
+
+def temp_owner_alive(name):
+    """Whether the process that is writing temp file ``name`` still runs."""
+    try:
+        pid = int(name.split(".")[1])
+    except (IndexError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TTLCache(object):
+    """Bounded LRU mapping whose entries expire after ``ttl`` seconds.
+
+    ``None`` is a valid value and is used for negative entries ("this key
+    does not exist"); :meth:`get` returns :data:`MISSING` when nothing is
+    cached.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class ChunkCache(object):
+    """LRU cache of object chunks bounded by their total size in bytes.
+
+    Chunks live in memory, up to ``max_bytes``, and, when ``directory``
+    is set, also on disk up to ``max_disk_bytes``; a chunk evicted from
+    memory is still served, and promoted back, from disk.  Keys should
+    include the object's ETag so that a replaced object never hits.
+
+    Concurrent readers of the same chunk share one fetch: the first one
+    gets to fetch it from :meth:`begin`, the others wait on the returned
+    event and then look the chunk up again.
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes if directory else 0
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        if self.max_disk_bytes:
+            self._load_disk()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self.max_disk_bytes > 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_disk(self):
+        """Index the chunks a previous run left in ``directory``."""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(TEMP_SUFFIX):
+                # Other workers sharing the directory may be writing theirs.
+                if not temp_owner_alive(name):
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    @staticmethod
+    def _disk_name(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def _evict_memory(self):
+        while self._memory_size > self.max_bytes and self._memory:
+            _, data = self._memory.popitem(last=False)
+            self._memory_size -= len(data)
+
+    def _evict_disk(self):
+        while self._disk_size > self.max_disk_bytes and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._memory[key] = data
+        self._memory_size += len(data)
+        self._evict_memory()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+            name = self._disk_name(key) if self.max_disk_bytes else None
+            if name not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(name)
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(name, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_size -= len(previous)
+            self._remember(key, data)
+            if not self.max_disk_bytes or len(data) > self.max_disk_bytes:
+                return
+            name = self._disk_name(key)
+        # Write under a temporary name, unique to this write as workers share
+        # the directory, so a crash never leaves a truncated chunk behind
+        # for the next run to serve.
+        path = self._path(name)
+        temp = "%s.%d.%s%s" % (path, os.getpid(), uuid.uuid4().hex, TEMP_SUFFIX)
+        try:
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError as e:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            logger.error("Could not write chunk %s to disk: %s", name, e)
+            return
+        with self._lock:
+            self._disk_size -= self._disk.pop(name, 0)
+            self._disk[name] = len(data)
+            self._disk_size += len(data)
+            self._evict_disk()
+
+    def begin(self, key):
+        """Return ``(True, event)`` if the caller must fetch ``key``.
+
+        The caller then calls :meth:`finish` once the chunk is stored, or
+        its fetch failed.  ``(False, event)`` means another thread is
+        fetching it already.
+        """
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is not None:
+                return False, event
+            event = self._in_flight[key] = threading.Event()
+            return True, event
+
+    def finish(self, key):
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def stats(self):
+        return {
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
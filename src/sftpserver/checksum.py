@@ -0,0 +1,145 @@
+"""
+Upload checksums.
+
+:class:`Checksums` digests a file as it is written, in the same pass
+that uploads or stages it, so checking an upload never reads the data
+again.  MD5 is always computed: S3 verifies it through ``Content-MD5``
+and it is what the returned ETag is compared with.  SHA-256 and, with
+the ``crc32c`` package installed, CRC32C can be added with
+``SFTP_UPLOAD_CHECKSUMS``; they are sent as ``x-amz-checksum-*`` headers
+and kept as ``x-amz-meta-*`` metadata of objects stored with a single
+PUT.  ``stat`` reports the digests known for a file as extended
+attributes named ``<algorithm>@sftpserver``.
+"""
+
+import base64
+import errno
+import hashlib
+
+from helper.logger import logger
+
+from . import settings
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # optional dependency
+    _crc32c = None
+
+ALGORITHMS = ("md5", "sha256", "crc32c")
+
+# Suffix of the SFTP extended attributes holding the digests.
+ATTRIBUTE_DOMAIN = "@sftpserver"
+
+
+class CRC32C(object):
+    """``hashlib``-style wrapper of the ``crc32c`` package."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = _crc32c.crc32c(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+def available(name):
+    return name in ALGORITHMS and (name != "crc32c" or _crc32c is not None)
+
+
+def configured_algorithms():
+    """MD5 plus the known, available algorithms of ``UPLOAD_CHECKSUMS``."""
+    names = ["md5"]
+    for name in settings.UPLOAD_CHECKSUMS:
+        if name in names:
+            continue
+        if not available(name):
+            logger.warning("Checksum %s is not available, skipping it", name)
+            continue
+        names.append(name)
+    return tuple(names)
+
+
+_algorithms = configured_algorithms()
+
+
+def new(name):
+    return CRC32C() if name == "crc32c" else hashlib.new(name)
+
+
+class Checksums(object):
+    """Running digests of the data passed to :meth:`update`."""
+
+    def __init__(self, algorithms=None):
+        self._hashes = {name: new(name) for name in algorithms or _algorithms}
+
+    def update(self, data):
+        for digest in self._hashes.values():
+            digest.update(data)
+
+    @property
+    def md5(self):
+        return self._hashes["md5"].hexdigest()
+
+    def hexdigests(self):
+        """``{algorithm: hex digest}`` of the data so far."""
+        return {name: digest.hexdigest() for name, digest in self._hashes.items()}
+
+
+def header_value(hexdigest):
+    """The base64 form S3 expects in ``Content-MD5`` and ``x-amz-checksum-*``."""
+    return base64.b64encode(bytes.fromhex(hexdigest)).decode("ascii")
+
+
+def upload_headers(checksums):
+    """Request headers sending ``{algorithm: hex digest}`` with a PUT."""
+    headers = {}
+    for name, hexdigest in checksums.items():
+        if name == "md5":
+            headers["Content-MD5"] = header_value(hexdigest)
+        else:
+            headers["x-amz-checksum-" + name] = header_value(hexdigest)
+        headers["x-amz-meta-" + name] = hexdigest
+    return headers
+
+
+def from_metadata(metadata):
+    """``{algorithm: hex digest}`` found in the user metadata of an object."""
+    return {
+        name: metadata[name].lower()
+        for name in ALGORITHMS
+        if metadata.get(name)
+    }
+
+
+def extended_attributes(checksums):
+    """SFTP extended attributes reporting ``checksums``."""
+    return {
+        name + ATTRIBUTE_DOMAIN: hexdigest
+        for name, hexdigest in sorted((checksums or {}).items())
+    }
+
+
+def multipart_etag(etags):
+    """The ETag S3 gives an object assembled from parts with ``etags``."""
+    digest = hashlib.md5(b"".join(bytes.fromhex(etag) for etag in etags))
+    return "%s-%d" % (digest.hexdigest(), len(etags))
+
+
+def verify_etag(storage, etag, expected, name):
+    """Raise ``EIO`` unless the ETag ``storage`` returned is ``expected``.
+
+    Only backends whose ETags are MD5s, and with ``SFTP_VERIFY_ETAGS``
+    on, are checked: objects encrypted with SSE-KMS have other ETags.
+    """
+    if not settings.VERIFY_ETAGS or not storage.md5_etags:
+        return
+    if etag != expected:
+        logger.error(
+            "ETag of %s is %s, expected %s from the data sent", name, etag, expected
+        )
+        raise OSError(errno.EIO, "Checksum mismatch on upload", name)
@@ -0,0 +1,103 @@
+"""
+Process-wide pool of S3 connections.
+
+Building an ``S3Connection`` is cheap, but every new one starts with an
+empty keep-alive socket pool, so its first requests pay a TCP and TLS
+handshake.  Sessions therefore draw their connection from this pool,
+keyed by credentials, and keep reusing the same warm sockets.
+"""
+
+import itertools
+import threading
+import time
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from helper.logger import logger
+
+from . import metrics, settings
+
+
+class MeteredS3Connection(S3Connection):
+    """``S3Connection`` counting the requests it sends by HTTP verb."""
+
+    def make_request(self, method, *args, **kwargs):
+        metrics.s3_requests_total.inc(labels=(method,))
+        return super(MeteredS3Connection, self).make_request(method, *args, **kwargs)
+
+
+class PooledConnection(object):
+    __slots__ = ("connection", "created", "healthy")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.healthy = True
+
+
+class S3ConnectionPool(object):
+    """Hand out up to ``size`` shared connections per set of credentials.
+
+    boto connections are safe to share between threads: each request
+    borrows its own socket from the connection's keep-alive pool.  The
+    pool spreads sessions over ``size`` connections round robin and
+    replaces connections that were reported broken.  Stale keep-alive
+    sockets are boto's business: its connection pool drops them itself.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or settings.S3_POOL_SIZE
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._counters = {}
+
+    def _connect(self, key, secret):
+        options = {}
+        if settings.S3_HOST:
+            options.update(
+                host=settings.S3_HOST,
+                port=settings.S3_PORT or None,
+                is_secure=settings.S3_SECURE,
+                calling_format=OrdinaryCallingFormat(),
+            )
+        return MeteredS3Connection(
+            aws_access_key_id=key, aws_secret_access_key=secret, **options
+        )
+
+    def _check(self, entries):
+        for entry in list(entries):
+            if not entry.healthy:
+                entries.remove(entry)
+                entry.connection.close()
+
+    def get(self, key, secret):
+        with self._lock:
+            credentials = (key, secret)
+            entries = self._entries.setdefault(credentials, [])
+            self._check(entries)
+            if len(entries) < self.size:
+                entry = PooledConnection(self._connect(key, secret))
+                entries.append(entry)
+            else:
+                counter = self._counters.setdefault(credentials, itertools.count())
+                entry = entries[next(counter) % len(entries)]
+            return entry.connection
+
+    def discard(self, connection):
+        """Mark ``connection`` broken so it is not handed out again."""
+        with self._lock:
+            for entries in self._entries.values():
+                for entry in entries:
+                    if entry.connection is connection:
+                        logger.warning("Discarding broken S3 connection")
+                        entry.healthy = False
+
+    def clear(self):
+        with self._lock:
+            for entries in self._entries.values():
+                for entry in entries:
+                    entry.connection.close()
+            self._entries.clear()
+            self._counters.clear()
+
+
+pool = S3ConnectionPool()
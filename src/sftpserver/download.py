@@ -0,0 +1,255 @@
+"""
+Offset-correct downloads.
+
+SFTP reads carry an offset; ``RangeReader`` serves each of them with an
+HTTP Range request.  Sequential access is detected and served from a
+read-ahead buffer whose window doubles on every sequential miss, while
+random access fetches exactly the requested range.
+
+Large objects are read by ``SegmentedReader``, which fetches fixed-size
+segments ahead of the reader over several S3 connections at once.
+
+Both can fetch through ``CachedFetch``, which keeps the chunks of hot
+objects in a process-wide ``ChunkCache`` shared by every session.
+"""
+
+import errno
+import functools
+from collections import OrderedDict
+
+from . import metrics, settings
+from .cache import ChunkCache
+from .storage import download_executor
+
+chunk_cache = ChunkCache(
+    settings.CHUNK_CACHE_SIZE,
+    settings.CHUNK_CACHE_DIR or None,
+    settings.CHUNK_CACHE_DISK_SIZE,
+)
+
+metrics.CallbackGauge(
+    "sftp_chunk_cache_hits_total",
+    "Object chunks served from the chunk cache.",
+    lambda: chunk_cache.hits,
+    kind="counter",
+)
+metrics.CallbackGauge(
+    "sftp_chunk_cache_misses_total",
+    "Object chunks fetched from S3.",
+    lambda: chunk_cache.misses,
+    kind="counter",
+)
+metrics.CallbackGauge(
+    "sftp_chunk_cache_bytes",
+    "Bytes held by the chunk cache in memory.",
+    lambda: chunk_cache.stats()["memory_bytes"],
+)
+
+
+class CachedFetch(object):
+    """``fetch(start, end)`` of one object version served from a chunk cache.
+
+    Ranges are widened to whole ``chunk_size`` chunks keyed by
+    ``(bucket, key, etag, index)``; runs of missing chunks are fetched
+    with a single request.  Chunks from S3 are pinned to ``etag`` by the
+    underlying fetch; before the first chunk is served from the cache,
+    ``validate()`` must confirm that ``etag`` is still current.
+    """
+
+    def __init__(self, cache, fetch, object_id, size, validate, chunk_size=None):
+        self.cache = cache
+        self.fetch = fetch
+        self.object_id = tuple(object_id)
+        self.size = size
+        self.validate = validate
+        self.chunk_size = chunk_size or settings.CHUNK_SIZE
+        self._validated = False
+
+    def _key(self, index):
+        return self.object_id + (index,)
+
+    def _bounds(self, first, last):
+        return (
+            first * self.chunk_size,
+            min((last + 1) * self.chunk_size, self.size),
+        )
+
+    def _cached(self, index):
+        data = self.cache.get(self._key(index))
+        if data is not None:
+            start, end = self._bounds(index, index)
+            if len(data) != end - start:
+                return None  # A damaged chunk, fetch it again.
+        if data is not None and not self._validated:
+            if self.validate() != self.object_id[-1]:
+                raise OSError(errno.ESTALE, "Object changed while reading it")
+            self._validated = True
+        return data
+
+    def _fetch_run(self, run, chunks):
+        start, end = self._bounds(run[0], run[-1])
+        try:
+            data = self.fetch(start, end)
+            for index in run:
+                offset = index * self.chunk_size - start
+                chunk = data[offset : offset + self.chunk_size]
+                self.cache.put(self._key(index), chunk)
+                chunks[index] = chunk
+        finally:
+            for index in run:
+                self.cache.finish(self._key(index))
+
+    def __call__(self, start, end):
+        first = start // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        chunks = {}
+        waiting = []
+        run = []
+        for index in range(first, last + 1):
+            data = self._cached(index)
+            if data is not None:
+                chunks[index] = data
+                continue
+            fetch, event = self.cache.begin(self._key(index))
+            if not fetch:
+                waiting.append((index, event))
+                continue
+            if run and run[-1] != index - 1:
+                self._fetch_run(run, chunks)
+                run = []
+            run.append(index)
+        if run:
+            self._fetch_run(run, chunks)
+        for index, event in waiting:
+            event.wait()
+            data = self._cached(index)
+            if data is None:
+                data = self.fetch(*self._bounds(index, index))
+            chunks[index] = data
+
+        data = b"".join(chunks[index] for index in range(first, last + 1))
+        offset = first * self.chunk_size
+        return data[start - offset : end - offset]
+
+
+class RangeReader(object):
+    """Read ``size`` bytes of an object through ``fetch(start, end)``.
+
+    ``fetch`` returns the bytes in ``[start, end)``.
+    """
+
+    def __init__(self, fetch, size, min_window=None, max_window=None):
+        self.fetch = fetch
+        self.size = size
+        self.min_window = min_window or settings.READAHEAD_MIN
+        self.max_window = max(max_window or settings.READAHEAD_MAX, self.min_window)
+        self.window = self.min_window
+        self._buffer = b""
+        self._buffer_offset = 0
+        self._next_offset = 0
+
+    def _buffered(self, offset, end):
+        start = offset - self._buffer_offset
+        if 0 <= start < len(self._buffer):
+            return self._buffer[start : end - self._buffer_offset]
+        return b""
+
+    def read(self, offset, length):
+        if offset >= self.size or length <= 0:
+            return b""
+        end = min(offset + length, self.size)
+        sequential = offset == self._next_offset
+        self._next_offset = end
+
+        data = self._buffered(offset, end)
+        offset += len(data)
+        if offset == end:
+            return data
+
+        if sequential:
+            fetch_end = min(max(end, offset + self.window), self.size)
+            self.window = min(self.window * 2, self.max_window)
+            self._buffer = self.fetch(offset, fetch_end)
+            self._buffer_offset = offset
+            return data + self._buffered(offset, end)
+
+        self.window = self.min_window
+        return data + self.fetch(offset, end)
+
+    def close(self):
+        self._buffer = b""
+
+
+class SegmentedReader(object):
+    """Read a large object as segments fetched in parallel.
+
+    Up to ``concurrency`` segments starting at the one being read are
+    fetched at the same time; a segment is dropped as soon as the reader
+    moves past it.  Nothing is fetched beyond that window, so a client
+    that reads slowly holds S3 connections and memory for at most
+    ``concurrency`` segments.  Reads outside the window that do not
+    continue the previous read are random access and go to a plain
+    ``RangeReader``.
+    """
+
+    def __init__(
+        self, fetch, size, segment_size=None, concurrency=None, submit=None
+    ):
+        self.fetch = fetch
+        # submit(start, end) starts fetching a segment and returns a Future.
+        self.submit = submit or functools.partial(download_executor.submit, fetch)
+        self.size = size
+        self.segment_size = segment_size or settings.DOWNLOAD_SEGMENT_SIZE
+        self.concurrency = concurrency or settings.DOWNLOAD_CONCURRENCY
+        self._count = -(-size // self.segment_size)
+        self._segments = OrderedDict()
+        self._next_offset = 0
+        self._random = RangeReader(fetch, size)
+
+    def _schedule(self, first):
+        last = min(first + self.concurrency, self._count)
+        for index in list(self._segments):
+            if not first <= index < last:
+                self._segments.pop(index).cancel()
+        for index in range(first, last):
+            if index not in self._segments:
+                start = index * self.segment_size
+                end = min(start + self.segment_size, self.size)
+                self._segments[index] = self.submit(start, end)
+
+    def read(self, offset, length):
+        if offset >= self.size or length <= 0:
+            return b""
+        end = min(offset + length, self.size)
+        sequential = (
+            offset == self._next_offset
+            or offset // self.segment_size in self._segments
+        )
+        self._next_offset = end
+        if not sequential:
+            return self._random.read(offset, length)
+
+        chunks = []
+        while offset < end:
+            index = offset // self.segment_size
+            self._schedule(index)
+            future = self._segments[index]
+            try:
+                data = future.result()
+            except BaseException:
+                # Fetch it again on the next read instead of failing them all.
+                if self._segments.get(index) is future:
+                    del self._segments[index]
+                raise
+            start = offset - index * self.segment_size
+            chunk = data[start : start + end - offset]
+            if not chunk:
+                raise OSError(errno.EIO, "Segment %d of the object is short" % index)
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        for future in self._segments.values():
+            future.cancel()
+        self._segments.clear()
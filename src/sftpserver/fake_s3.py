@@ -0,0 +1,451 @@
+"""
+A small in-process S3 stand-in for benchmarks and load tests.
+
+It speaks enough of the S3 REST API (path-style addressing, no
+authentication) for boto's ``S3Connection`` to list, read, write, copy
+and delete objects, including ranged GETs and multipart uploads.  All
+data lives in memory.
+"""
+
+import base64
+import bisect
+import hashlib
+import threading
+import uuid
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class FakeObject(object):
+    __slots__ = ("data", "etag", "mtime", "metadata")
+
+    def __init__(self, data, etag=None, metadata=None):
+        self.data = data
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.mtime = datetime.now(timezone.utc)
+        self.metadata = metadata or {}
+
+
+class FakeBucket(dict):
+    """Objects of a bucket by key, with the keys also kept in sorted order
+    so that listing a page does not sort the whole bucket."""
+
+    def __init__(self):
+        super(FakeBucket, self).__init__()
+        self.names = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            bisect.insort(self.names, key)
+        super(FakeBucket, self).__setitem__(key, value)
+
+    def pop(self, key, default=None):
+        if key in self:
+            del self.names[bisect.bisect_left(self.names, key)]
+        return super(FakeBucket, self).pop(key, default)
+
+
+def _successor(prefix):
+    """Smallest string sorting after every string starting with ``prefix``."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class FakeS3Storage(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.requests = 0
+
+
+def _iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _http_date(dt):
+    return formatdate(dt.timestamp(), usegmt=True)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; with Nagle on, the body
+    # waits for the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+    storage = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # -- plumbing -----------------------------------------------------------
+
+    def _parse(self):
+        with self.storage.lock:
+            self.storage.requests += 1
+        url = urlsplit(self.path)
+        parts = unquote(url.path).lstrip("/").split("/", 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else ""
+        query = {k: v[0] for k, v in parse_qs(url.query, True).items()}
+        return bucket, key, query
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.command != "HEAD" or "Content-Length" not in (headers or {}):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _xml(self, status, body):
+        xml = '<?xml version="1.0" encoding="UTF-8"?>' + body
+        self._send(status, xml, {"Content-Type": "application/xml"})
+
+    def _error(self, status, code, message=""):
+        self._xml(
+            status,
+            "<Error><Code>%s</Code><Message>%s</Message></Error>"
+            % (code, escape(message)),
+        )
+
+    def _bucket(self, name):
+        bucket = self.storage.buckets.get(name)
+        if bucket is None:
+            self._error(404, "NoSuchBucket", name)
+        return bucket
+
+    # -- verbs --------------------------------------------------------------
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket_name, key, query = self._parse()
+        if not bucket_name:
+            return self._list_buckets()
+        with self.storage.lock:
+            bucket = self._bucket(bucket_name)
+            if bucket is None:
+                return
+            if not key:
+                if self.command == "HEAD":
+                    return self._send(200)
+                return self._list_objects(bucket, bucket_name, query)
+            obj = bucket.get(key)
+        if obj is None:
+            return self._error(404, "NoSuchKey", key)
+        if_match = self.headers.get("If-Match")
+        if if_match and if_match.strip('"') != obj.etag:
+            return self._error(412, "PreconditionFailed", key)
+        headers = {
+            "ETag": '"%s"' % obj.etag,
+            "Last-Modified": _http_date(obj.mtime),
+            "Content-Type": "application/octet-stream",
+            "Accept-Ranges": "bytes",
+        }
+        for name, value in obj.metadata.items():
+            headers["x-amz-meta-" + name] = value
+        data = obj.data
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range and byte_range.startswith("bytes="):
+            start, _, end = byte_range[6:].partition("-")
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            if start >= len(data):
+                return self._error(416, "InvalidRange", key)
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            data = data[start : end + 1]
+            status = 206
+        if self.command == "HEAD":
+            headers["Content-Length"] = str(len(data))
+            return self._send(status, b"", headers)
+        self._send(status, data, headers)
+
+    def do_PUT(self):
+        bucket_name, key, query = self._parse()
+        body = self._body()
+        md5 = self.headers.get("Content-MD5")
+        if md5 and base64.b64decode(md5) != hashlib.md5(body).digest():
+            return self._error(400, "BadDigest", key)
+        with self.storage.lock:
+            if not key:
+                self.storage.buckets.setdefault(bucket_name, FakeBucket())
+                return self._send(200)
+            bucket = self._bucket(bucket_name)
+            if bucket is None:
+                return
+            copy_source = self.headers.get("x-amz-copy-source")
+            if copy_source:
+                source = self._copy_source(copy_source)
+                if source is None:
+                    return self._error(404, "NoSuchKey", copy_source)
+                body = source.data
+                copy_range = self.headers.get("x-amz-copy-source-range")
+                if copy_range:
+                    start, end = copy_range[6:].split("-")
+                    body = body[int(start) : int(end) + 1]
+            if "uploadId" in query:
+                upload = self.storage.uploads.get(query["uploadId"])
+                if upload is None:
+                    return self._error(404, "NoSuchUpload", key)
+                part = FakeObject(body)
+                upload["parts"][int(query["partNumber"])] = part
+                if copy_source:
+                    return self._xml(
+                        200,
+                        "<CopyPartResult><LastModified>%s</LastModified>"
+                        '<ETag>"%s"</ETag></CopyPartResult>'
+                        % (_iso(part.mtime), part.etag),
+                    )
+                return self._send(200, b"", {"ETag": '"%s"' % part.etag})
+            metadata = self._metadata()
+            if copy_source and self.headers.get("x-amz-metadata-directive") != "REPLACE":
+                metadata = dict(source.metadata)
+            obj = bucket[key] = FakeObject(body, metadata=metadata)
+        if copy_source:
+            return self._xml(
+                200,
+                "<CopyObjectResult><LastModified>%s</LastModified>"
+                '<ETag>"%s"</ETag></CopyObjectResult>' % (_iso(obj.mtime), obj.etag),
+            )
+        self._send(200, b"", {"ETag": '"%s"' % obj.etag})
+
+    def do_POST(self):
+        bucket_name, key, query = self._parse()
+        body = self._body()
+        with self.storage.lock:
+            bucket = self._bucket(bucket_name)
+            if bucket is None:
+                return
+            if "delete" in query:
+                return self._delete_objects(bucket, body)
+            if "uploads" in query:
+                upload_id = uuid.uuid4().hex
+                self.storage.uploads[upload_id] = {
+                    "bucket": bucket_name,
+                    "key": key,
+                    "parts": {},
+                    "metadata": self._metadata(),
+                }
+                return self._xml(
+                    200,
+                    "<InitiateMultipartUploadResult><Bucket>%s</Bucket>"
+                    "<Key>%s</Key><UploadId>%s</UploadId>"
+                    "</InitiateMultipartUploadResult>"
+                    % (escape(bucket_name), escape(key), upload_id),
+                )
+            if "uploadId" in query:
+                upload = self.storage.uploads.pop(query["uploadId"], None)
+                if upload is None:
+                    return self._error(404, "NoSuchUpload", key)
+                parts = [upload["parts"][n] for n in sorted(upload["parts"])]
+                digest = hashlib.md5(
+                    b"".join(bytes.fromhex(p.etag) for p in parts)
+                ).hexdigest()
+                etag = "%s-%d" % (digest, len(parts))
+                bucket[key] = FakeObject(
+                    b"".join(p.data for p in parts),
+                    etag=etag,
+                    metadata=upload["metadata"],
+                )
+                return self._xml(
+                    200,
+                    "<CompleteMultipartUploadResult><Bucket>%s</Bucket>"
+                    '<Key>%s</Key><ETag>"%s"</ETag>'
+                    "</CompleteMultipartUploadResult>"
+                    % (escape(bucket_name), escape(key), etag),
+                )
+        self._error(400, "InvalidRequest", self.path)
+
+    def do_DELETE(self):
+        bucket_name, key, query = self._parse()
+        with self.storage.lock:
+            if "uploadId" in query:
+                self.storage.uploads.pop(query["uploadId"], None)
+                return self._send(204)
+            bucket = self._bucket(bucket_name)
+            if bucket is None:
+                return
+            if not key:
+                if bucket:
+                    return self._error(409, "BucketNotEmpty", bucket_name)
+                del self.storage.buckets[bucket_name]
+                return self._send(204)
+            bucket.pop(key, None)
+        self._send(204)
+
+    # -- helpers ------------------------------------------------------------
+
+    def _metadata(self):
+        return {
+            name[len("x-amz-meta-") :].lower(): value
+            for name, value in self.headers.items()
+            if name.lower().startswith("x-amz-meta-")
+        }
+
+    def _copy_source(self, copy_source):
+        source_bucket, _, source_key = unquote(copy_source).lstrip("/").partition("/")
+        return self.storage.buckets.get(source_bucket, {}).get(source_key)
+
+    def _list_buckets(self):
+        with self.storage.lock:
+            names = sorted(self.storage.buckets)
+        now = _iso(datetime.now(timezone.utc))
+        self._xml(
+            200,
+            '<ListAllMyBucketsResult xmlns="%s"><Owner><ID>fake</ID></Owner>'
+            "<Buckets>%s</Buckets></ListAllMyBucketsResult>"
+            % (
+                XMLNS,
+                "".join(
+                    "<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>"
+                    % (escape(name), now)
+                    for name in names
+                ),
+            ),
+        )
+
+    def _list_objects(self, bucket, bucket_name, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        marker = query.get("marker", "")
+        max_keys = int(query.get("max-keys", "1000"))
+        contents, prefixes = [], []
+        truncated = False
+        last = None
+        names = bucket.names
+        i = max(
+            bisect.bisect_left(names, prefix), bisect.bisect_right(names, marker)
+        )
+        while i < len(names):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            i += 1
+            if delimiter:
+                index = name.find(delimiter, len(prefix))
+                if index >= 0:
+                    common = name[: index + len(delimiter)]
+                    # Skip the rest of the keys rolled up into this prefix.
+                    i = bisect.bisect_left(names, _successor(common), i)
+                    if common <= marker:
+                        continue
+                    if len(contents) + len(prefixes) >= max_keys:
+                        truncated = True
+                        break
+                    prefixes.append(common)
+                    last = common
+                    continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            contents.append((name, bucket[name]))
+            last = name
+        body = [
+            '<ListBucketResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>'
+            "<Marker>%s</Marker><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>"
+            % (
+                XMLNS,
+                escape(bucket_name),
+                escape(prefix),
+                escape(marker),
+                max_keys,
+                "true" if truncated else "false",
+            )
+        ]
+        if delimiter:
+            body.append("<Delimiter>%s</Delimiter>" % escape(delimiter))
+            if truncated and last:
+                body.append("<NextMarker>%s</NextMarker>" % escape(last))
+        for name, obj in contents:
+            body.append(
+                "<Contents><Key>%s</Key><LastModified>%s</LastModified>"
+                '<ETag>"%s"</ETag><Size>%d</Size>'
+                "<StorageClass>STANDARD</StorageClass></Contents>"
+                % (escape(name), _iso(obj.mtime), obj.etag, len(obj.data))
+            )
+        for common in prefixes:
+            body.append(
+                "<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" % escape(common)
+            )
+        body.append("</ListBucketResult>")
+        self._xml(200, "".join(body))
+
+    def _delete_objects(self, bucket, body):
+        root = ElementTree.fromstring(body)
+        deleted = []
+        for element in root.iter():
+            if element.tag.endswith("Key"):
+                bucket.pop(element.text, None)
+                deleted.append(element.text)
+        self._xml(
+            200,
+            '<DeleteResult xmlns="%s">%s</DeleteResult>'
+            % (
+                XMLNS,
+                "".join(
+                    "<Deleted><Key>%s</Key></Deleted>" % escape(name)
+                    for name in deleted
+                ),
+            ),
+        )
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # Accept as many simultaneous connections as a pooled client opens.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeS3Server(object):
+    """Run :class:`FakeS3Handler` on a background thread.
+
+    >>> fake = FakeS3Server().start()
+    >>> fake.create_bucket("feeds")
+    >>> fake.port
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.storage = FakeS3Storage()
+        handler = type("Handler", (FakeS3Handler,), {"storage": self.storage})
+        self.httpd = _HTTPServer((host, port), handler)
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="fake-s3", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def create_bucket(self, name):
+        with self.storage.lock:
+            self.storage.buckets.setdefault(name, FakeBucket())
+
+    def put_object(self, name, key, data):
+        with self.storage.lock:
+            bucket = self.storage.buckets.setdefault(name, FakeBucket())
+            bucket[key] = FakeObject(data)
+
+    @property
+    def request_count(self):
+        return self.storage.requests
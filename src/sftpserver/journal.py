@@ -0,0 +1,592 @@
+"""
+Write-back upload journal.
+
+With ``SFTP_UPLOAD_MODE=writeback`` a file being written is staged in
+the journal directory, and ``close`` returns as soon as it is durable
+there.  A pool of uploader threads drains the journal to the storage
+backend in the background, retrying failures with a growing delay, so
+clients dropping many files in a row no longer wait for S3 on every
+close.
+
+Each entry is a data file plus a small JSON record; writing the record
+is the commit, and the entry is removed once its upload succeeded.
+The data is checksummed while it is staged, so even a multipart upload
+of it carries its checksums, and an upload whose data no longer matches
+them fails.
+Every process journals into its own sub-directory, holding an ``flock``
+on it for its lifetime; on start a process adopts the entries of
+sub-directories whose owner is gone, so pending uploads survive a
+restart or a crashed worker.  A sub-directory is locked under a hidden
+temporary name and only then renamed into view, so no other process
+can take it for abandoned before its owner holds the lock.
+
+Until its upload completes, a pending file is what ``stat``, ``open``
+and directory listings in the same process see.
+"""
+
+import errno
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from helper.debug import function_debuger
+from helper.logger import logger
+
+from . import metrics, settings
+from .cache import temp_owner_alive
+from .checksum import Checksums
+from .storage import DIRECTORY, FILE, ObjectInfo, open_backend
+from .upload import MultipartWriter
+
+DATA_SUFFIX = ".data"
+RECORD_SUFFIX = ".json"
+LOCK_NAME = "lock"
+FAILED_DIR = "failed"
+
+# Seconds before the first retry of a failed upload, doubled on every
+# further failure up to RETRY_MAX_DELAY.
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 300
+
+uploads_total = metrics.Counter(
+    "sftp_journal_uploads_total", "Journaled files uploaded to storage."
+)
+upload_errors_total = metrics.Counter(
+    "sftp_journal_upload_errors_total", "Failed attempts to upload journaled files."
+)
+metrics.CallbackGauge(
+    "sftp_journal_pending_uploads",
+    "Files closed by clients and not uploaded yet.",
+    lambda: _journal.pending_count if _journal is not None else 0,
+)
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Entry(object):
+    """A file staged in the journal."""
+
+    __slots__ = (
+        "id",
+        "bucket_name",
+        "key_name",
+        "size",
+        "mtime",
+        "directory",
+        "superseded",
+        "attempts",
+        "done",
+        "checksums",
+    )
+
+    def __init__(
+        self, entry_id, bucket_name, key_name, size, mtime, directory, checksums=None
+    ):
+        self.id = entry_id
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.size = size
+        self.mtime = mtime
+        self.directory = directory
+        # {algorithm: hex digest} of the data, computed while it was staged.
+        self.checksums = checksums
+        self.superseded = False
+        self.attempts = 0
+        self.done = threading.Event()
+
+    @property
+    def data_path(self):
+        return os.path.join(self.directory, self.id + DATA_SUFFIX)
+
+    @property
+    def record_path(self):
+        return os.path.join(self.directory, self.id + RECORD_SUFFIX)
+
+    @property
+    def info(self):
+        return ObjectInfo(
+            self.key_name, self.size, int(self.mtime), "", FILE, self.checksums
+        )
+
+
+class StagedFile(object):
+    """A file being written into the journal; nothing is pending until
+    :meth:`commit`."""
+
+    def __init__(self, journal, bucket_name, key_name):
+        self.journal = journal
+        self.entry = Entry(
+            "%016x-%s" % (time.time_ns(), uuid.uuid4().hex[:8]),
+            bucket_name,
+            key_name,
+            0,
+            0,
+            journal.directory,
+        )
+        self._file = open(self.entry.data_path, "wb")
+        self._checksums = Checksums()
+
+    def write(self, data):
+        self._file.write(data)
+        self._checksums.update(data)
+        self.entry.size += len(data)
+
+    def commit(self):
+        """Make the file durable and queue its upload."""
+        self._file.flush()
+        if settings.JOURNAL_FSYNC:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self.entry.mtime = time.time()
+        self.entry.checksums = self._checksums.hexdigests()
+        self.journal.commit(self.entry)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self.entry.data_path)
+
+
+class Journal(object):
+    """Stage uploads in ``root`` and upload them with ``workers`` threads."""
+
+    def __init__(self, root, workers=None, retries=None):
+        self.root = os.path.abspath(root)
+        self.workers = workers or settings.JOURNAL_WORKERS
+        self.retries = settings.JOURNAL_RETRIES if retries is None else retries
+        self.directory = os.path.join(
+            self.root, "%d-%s" % (os.getpid(), uuid.uuid4().hex[:8])
+        )
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # (not before, sequence, Entry) heap of queued uploads.
+        self._queue = []
+        self._sequence = itertools.count()
+        # (bucket name, key name) -> newest pending Entry.
+        self._pending = {}
+        # (bucket name, key name) of the uploads in progress.
+        self._uploading = set()
+        self._threads = []
+        self._lock_file = None
+        self._stopping = False
+
+    # -- lifecycle ----------------------------------------------------------
+
+    @function_debuger
+    def start(self):
+        temp = os.path.join(
+            self.root, ".%d.%s" % (os.getpid(), os.path.basename(self.directory))
+        )
+        os.makedirs(temp)
+        self._lock_file = open(os.path.join(temp, LOCK_NAME), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(temp, self.directory)
+        self.recover()
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name="journal-%d" % index, daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    @function_debuger
+    def stop(self, timeout=None):
+        """Stop the uploaders; entries not uploaded yet stay on disk."""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._lock_file.close()
+
+    @function_debuger
+    def recover(self):
+        """Adopt the entries left behind by processes that are gone."""
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if path == self.directory or name == FAILED_DIR:
+                continue
+            if name.startswith("."):
+                # Still being set up, or left over by a start that died.
+                if not temp_owner_alive(name):
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not os.path.isdir(path):
+                continue
+            try:
+                lock_file = open(os.path.join(path, LOCK_NAME), "a")
+            except OSError:
+                continue
+            with lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Its owner is still running.
+                self._adopt(path)
+
+    def _adopt(self, path):
+        adopted = 0
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(RECORD_SUFFIX):
+                continue
+            entry_id = name[: -len(RECORD_SUFFIX)]
+            try:
+                with open(os.path.join(path, name)) as f:
+                    record = json.load(f)
+                os.rename(
+                    os.path.join(path, entry_id + DATA_SUFFIX),
+                    os.path.join(self.directory, entry_id + DATA_SUFFIX),
+                )
+            except (OSError, ValueError) as e:
+                logger.error("Cannot recover journal entry %s: %s", name, e)
+                continue
+            entry = Entry(
+                entry_id,
+                record["bucket"],
+                record["key"],
+                record["size"],
+                record["mtime"],
+                self.directory,
+                record.get("checksums"),
+            )
+            self._write_record(entry)
+            os.remove(os.path.join(path, name))
+            self._enqueue(entry)
+            adopted += 1
+        # Data files without a record were never committed.
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+        if adopted:
+            logger.info("Recovered %d pending uploads from %s", adopted, path)
+
+    # -- staging ------------------------------------------------------------
+
+    def create(self, bucket_name, key_name):
+        return StagedFile(self, bucket_name, key_name)
+
+    def _write_record(self, entry):
+        record = {
+            "bucket": entry.bucket_name,
+            "key": entry.key_name,
+            "size": entry.size,
+            "mtime": entry.mtime,
+            "checksums": entry.checksums,
+        }
+        temp = entry.record_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(record, f)
+            f.flush()
+            if settings.JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        os.rename(temp, entry.record_path)
+        if settings.JOURNAL_FSYNC:
+            fsync_directory(entry.directory)
+
+    @function_debuger
+    def commit(self, entry):
+        self._write_record(entry)
+        self._enqueue(entry)
+
+    def _enqueue(self, entry, delay=0):
+        with self._lock:
+            name = (entry.bucket_name, entry.key_name)
+            previous = self._pending.get(name)
+            if previous is not None and previous is not entry:
+                previous.superseded = True
+            self._pending[name] = entry
+            heapq.heappush(
+                self._queue, (time.time() + delay, next(self._sequence), entry)
+            )
+            self._wakeup.notify()
+
+    # -- lookups ------------------------------------------------------------
+
+    def lookup(self, bucket_name, key_name):
+        """The pending ``Entry`` of a key, or None."""
+        with self._lock:
+            return self._pending.get((bucket_name, key_name))
+
+    def resolve(self, bucket_name, key_name):
+        """``ObjectInfo`` of a pending file, or of a directory holding one."""
+        entry = self.lookup(bucket_name, key_name)
+        if entry is not None:
+            return entry.info
+        prefix = key_name.rstrip("/") + "/"
+        if self.has_prefix(bucket_name, prefix):
+            return ObjectInfo(prefix, 0, 0, "", DIRECTORY)
+        return None
+
+    def has_prefix(self, bucket_name, prefix):
+        """Whether a pending key makes ``prefix`` a directory."""
+        with self._lock:
+            return any(
+                bucket == bucket_name and key.startswith(prefix)
+                for bucket, key in self._pending
+            )
+
+    def children(self, bucket_name, prefix):
+        """``ObjectInfo`` of the pending entries directly below ``prefix``."""
+        infos = {}
+        with self._lock:
+            entries = list(self._pending.values())
+        for entry in entries:
+            if entry.bucket_name != bucket_name:
+                continue
+            if not entry.key_name.startswith(prefix):
+                continue
+            index = entry.key_name.find("/", len(prefix))
+            if index < 0:
+                infos[entry.key_name] = entry.info
+            else:
+                name = entry.key_name[: index + 1]
+                infos[name] = ObjectInfo(name, 0, 0, "", DIRECTORY)
+        return [infos[name] for name in sorted(infos)]
+
+    @function_debuger
+    def settle(self, bucket_name, key_name=None, prefix=None, discard=False):
+        """Wait for the pending uploads of a key or of every key below
+        ``prefix``; with ``discard`` those not started are dropped at once.
+
+        Raises ``EAGAIN`` if they are still pending after
+        ``SFTP_JOURNAL_SETTLE_TIMEOUT`` seconds.
+        """
+
+        def matches(bucket, key):
+            return bucket == bucket_name and (
+                key == key_name or (prefix and key.startswith(prefix))
+            )
+
+        dropped = []
+        with self._lock:
+            entries = [
+                entry
+                for (bucket, key), entry in self._pending.items()
+                if matches(bucket, key)
+            ]
+            if discard:
+                for entry in entries:
+                    entry.superseded = True
+                queue = []
+                for item in self._queue:
+                    entry = item[2]
+                    if matches(entry.bucket_name, entry.key_name):
+                        entry.superseded = True
+                        dropped.append(entry)
+                    else:
+                        queue.append(item)
+                if dropped:
+                    heapq.heapify(queue)
+                    self._queue = queue
+                    for entry in dropped:
+                        name = (entry.bucket_name, entry.key_name)
+                        if self._pending.get(name) is entry:
+                            del self._pending[name]
+        for entry in dropped:
+            for path in (entry.record_path, entry.data_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            entry.done.set()
+        deadline = time.monotonic() + settings.JOURNAL_SETTLE_TIMEOUT
+        for entry in entries:
+            if not entry.done.wait(max(0, deadline - time.monotonic())):
+                raise OSError(
+                    errno.EAGAIN,
+                    "Upload of %s/%s is still pending"
+                    % (entry.bucket_name, entry.key_name),
+                )
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    # -- uploads ------------------------------------------------------------
+
+    def _next(self):
+        with self._lock:
+            while not self._stopping:
+                now = time.time()
+                if self._queue and self._queue[0][0] <= now:
+                    _, _, entry = heapq.heappop(self._queue)
+                    name = (entry.bucket_name, entry.key_name)
+                    if name in self._uploading:
+                        # Older data of the same key is being uploaded,
+                        # the newer upload must land after it.
+                        heapq.heappush(
+                            self._queue, (now + 0.1, next(self._sequence), entry)
+                        )
+                        continue
+                    self._uploading.add(name)
+                    return entry
+                timeout = self._queue[0][0] - now if self._queue else None
+                self._wakeup.wait(timeout)
+        return None
+
+    def _run(self):
+        storage = None
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            try:
+                if storage is None:
+                    storage = open_backend(
+                        settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY
+                    )
+                self._upload(storage, entry)
+            except Exception as e:
+                self._failed(entry, e)
+            else:
+                self._finish(entry)
+
+    @function_debuger
+    def _upload(self, storage, entry):
+        if entry.superseded:
+            return
+        writer = MultipartWriter(
+            storage, entry.bucket_name, entry.key_name, checksums=entry.checksums
+        )
+        try:
+            with open(entry.data_path, "rb") as f:
+                while True:
+                    data = f.read(writer.part_size)
+                    if not data:
+                        break
+                    writer.write(data)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            storage.invalidate_object(entry.bucket_name, entry.key_name)
+        uploads_total.inc()
+
+    def _failed(self, entry, error):
+        entry.attempts += 1
+        upload_errors_total.inc()
+        if entry.attempts <= self.retries and not entry.superseded:
+            delay = min(RETRY_DELAY * 2 ** (entry.attempts - 1), RETRY_MAX_DELAY)
+            logger.warning(
+                "Upload of %s/%s failed (%s), retrying in %ds",
+                entry.bucket_name,
+                entry.key_name,
+                error,
+                delay,
+            )
+            with self._lock:
+                self._uploading.discard((entry.bucket_name, entry.key_name))
+                heapq.heappush(
+                    self._queue,
+                    (time.time() + delay, next(self._sequence), entry),
+                )
+                self._wakeup.notify()
+            return
+        if not entry.superseded:
+            failed = os.path.join(self.root, FAILED_DIR)
+            logger.error(
+                "Giving up on upload of %s/%s after %d attempts, keeping it in %s",
+                entry.bucket_name,
+                entry.key_name,
+                entry.attempts,
+                failed,
+            )
+            os.makedirs(failed, exist_ok=True)
+            for path in (entry.data_path, entry.record_path):
+                os.rename(path, os.path.join(failed, os.path.basename(path)))
+        self._finish(entry)
+
+    def _finish(self, entry):
+        name = (entry.bucket_name, entry.key_name)
+        for path in (entry.record_path, entry.data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._uploading.discard(name)
+            if self._pending.get(name) is entry:
+                del self._pending[name]
+            self._wakeup.notify()
+        entry.done.set()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def start_journal(root=None):
+    """Start this process's journal, once, and recover pending uploads."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            os.makedirs(root or settings.JOURNAL_DIR, exist_ok=True)
+            _journal = Journal(root or settings.JOURNAL_DIR).start()
+        return _journal
+
+
+def stop_journal(timeout=None):
+    global _journal
+    with _journal_lock:
+        journal, _journal = _journal, None
+    if journal is not None:
+        journal.stop(timeout)
+
+
+def get_journal():
+    """The running journal, or None when write-back is off."""
+    return _journal
+
+
+def pending_entry(bucket_name, key_name):
+    """The pending ``Entry`` of a key in the running journal, if any."""
+    journal = _journal
+    return journal.lookup(bucket_name, key_name) if journal is not None else None
+
+
+def pending_info(bucket_name, key_name):
+    """:meth:`Journal.resolve` of the running journal, if any."""
+    journal = _journal
+    return journal.resolve(bucket_name, key_name) if journal is not None else None
+
+
+def settle(bucket_name, key_name=None, prefix=None, discard=False):
+    """:meth:`Journal.settle` of the running journal, if any."""
+    journal = _journal
+    if journal is not None:
+        journal.settle(bucket_name, key_name, prefix, discard)
+
+
+def merge_pending(bucket_name, prefix, infos):
+    """Merge the pending entries below ``prefix`` into the directory
+    listing ``infos``; a pending file replaces a listed one."""
+    journal = _journal
+    pending = journal.children(bucket_name, prefix) if journal is not None else []
+    if not pending:
+        return infos
+
+    def merged():
+        previous = None
+        for name, _, info in heapq.merge(
+            ((info.name, 0, info) for info in pending),
+            ((info.name, 1, info) for info in infos),
+            key=lambda item: item[:2],
+        ):
+            if name != previous:
+                yield info
+            previous = name
+
+    return merged()
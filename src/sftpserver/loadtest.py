@@ -0,0 +1,315 @@
+"""
+Multi-client load generator.
+
+Opens ``--clients`` concurrent SFTP sessions and has each of them run a
+random mix of operations for ``--duration`` seconds, then reports
+p50/p95/p99 latency and error rate per operation and the aggregate
+throughput::
+
+    python -m sftpserver.loadtest --clients 200 --duration 60 \\
+        --mix put=1,get=4,ls=1,stat=4 --sizes 16k=6,1m=3,32m=1
+
+By default the server is started locally through its entry point against
+an in-process S3 stand-in, as in :mod:`sftpserver.benchmark`; ``--target
+HOST:PORT`` drives an already running server instead.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from .benchmark import BUCKET, ServerProcess
+from .fake_s3 import FakeS3Server
+
+OPERATIONS = ("put", "get", "ls", "stat")
+SEED_FILES = 20
+UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().lower().rstrip("b")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+    return int(float(text[: len(text) - len(unit)]) * UNITS[unit])
+
+
+def parse_weights(text, parse_key=str):
+    """Parse ``"a=1,b=3"`` into ``([a, b], [1, 3])``."""
+    keys, weights = [], []
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        keys.append(parse_key(key))
+        weights.append(float(weight or 1))
+    return keys, weights
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Stats(object):
+    """Latencies, errors and bytes of one client, merged at the end."""
+
+    def __init__(self):
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.bytes = 0
+
+    def merge(self, other):
+        for op in OPERATIONS:
+            self.latencies[op].extend(other.latencies[op])
+            self.errors[op] += other.errors[op]
+        self.bytes += other.bytes
+
+
+class Client(threading.Thread):
+    def __init__(self, number, connect, args, deadline, start_barrier):
+        super(Client, self).__init__(name="client-%d" % number, daemon=True)
+        self.number = number
+        self.connect = connect
+        self.args = args
+        self.deadline = deadline
+        self.start_barrier = start_barrier
+        self.random = random.Random(args.seed + number)
+        self.stats = Stats()
+        self.connect_error = None
+        self.uploaded = []
+
+    def run(self):
+        try:
+            transport, sftp = self.connect()
+        except Exception as e:
+            self.connect_error = e
+            self.start_barrier.wait()
+            return
+        self.start_barrier.wait()
+        try:
+            while time.time() < self.deadline[0]:
+                op = self.random.choices(self.args.ops, self.args.op_weights)[0]
+                start = time.perf_counter()
+                try:
+                    self.stats.bytes += getattr(self, "do_" + op)(sftp)
+                except Exception:
+                    self.stats.errors[op] += 1
+                self.stats.latencies[op].append(time.perf_counter() - start)
+        finally:
+            transport.close()
+
+    def seed_path(self):
+        return "/%s/load/seed/%d" % (BUCKET, self.random.randrange(SEED_FILES))
+
+    def do_put(self, sftp):
+        size = self.random.choices(self.args.sizes, self.args.size_weights)[0]
+        path = "/%s/load/c%d/%d" % (BUCKET, self.number, len(self.uploaded))
+        sftp.putfo(io.BytesIO(self.args.payload[:size]), path, size, confirm=False)
+        self.uploaded.append(path)
+        return size
+
+    def do_get(self, sftp):
+        path = self.seed_path()
+        if self.uploaded and self.random.random() < 0.5:
+            path = self.random.choice(self.uploaded)
+        return sftp.getfo(path, io.BytesIO())
+
+    def do_ls(self, sftp):
+        sftp.listdir_attr("/%s/load/seed" % BUCKET)
+        return 0
+
+    def do_stat(self, sftp):
+        sftp.stat(self.seed_path())
+        return 0
+
+
+def run(args, connect, seed):
+    for i in range(SEED_FILES):
+        size = random.Random(args.seed - i).choices(args.sizes, args.size_weights)[0]
+        seed("load/seed/%d" % i, args.payload[:size])
+
+    deadline = [0]
+
+    def start():
+        # Runs once every session is connected, before any is released.
+        deadline[0] = time.time() + args.duration
+
+    start_barrier = threading.Barrier(args.clients + 1, action=start)
+    clients = [
+        Client(i, connect, args, deadline, start_barrier)
+        for i in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    start_barrier.wait()
+    started = time.time()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started
+
+    total = Stats()
+    for client in clients:
+        total.merge(client.stats)
+    failed = [client for client in clients if client.connect_error is not None]
+    operations = {}
+    for op in OPERATIONS:
+        ordered = sorted(total.latencies[op])
+        if not ordered:
+            continue
+        operations[op] = {
+            "count": len(ordered),
+            "errors": total.errors[op],
+            "error_rate": total.errors[op] / len(ordered),
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+    count = sum(op["count"] for op in operations.values())
+    return {
+        "clients": args.clients,
+        "failed_connections": len(failed),
+        "duration": elapsed,
+        "operations": operations,
+        "ops_per_second": count / elapsed,
+        "mb_per_second": total.bytes / 1024 ** 2 / elapsed,
+    }
+
+
+def print_report(report):
+    print(
+        "%d clients (%d failed to connect), %.1fs"
+        % (report["clients"], report["failed_connections"], report["duration"])
+    )
+    print(
+        "%-5s %8s %7s %10s %10s %10s %10s"
+        % ("op", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    )
+    for op, row in sorted(report["operations"].items()):
+        print(
+            "%-5s %8d %6.2f%% %10.2f %10.2f %10.2f %10.2f"
+            % (
+                op,
+                row["count"],
+                row["error_rate"] * 100,
+                row["p50_ms"],
+                row["p95_ms"],
+                row["p99_ms"],
+                row["max_ms"],
+            )
+        )
+    print(
+        "%.1f ops/s, %.2f MB/s" % (report["ops_per_second"], report["mb_per_second"])
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sftpserver.loadtest", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "-c",
+        "--clients",
+        type=int,
+        default=50,
+        help="concurrent sessions [default: %(default)d]",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=30,
+        help="seconds to run the workload [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--mix",
+        default="put=1,get=4,ls=1,stat=4",
+        help="relative weights of put, get, ls and stat [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="16k=6,1m=3,32m=1",
+        help="file sizes of put and their weights [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [default: %(default)d]"
+    )
+    parser.add_argument(
+        "--target",
+        metavar="HOST:PORT",
+        help="drive a running server instead of starting one on a fake S3; "
+        "its bucket '%s' must exist" % BUCKET,
+    )
+    parser.add_argument(
+        "-u",
+        "--username",
+        default="load",
+        help="login for --target [default: %(default)s]",
+    )
+    parser.add_argument(
+        "-P", "--password", default="load", help="password for --target"
+    )
+    parser.add_argument(
+        "-o", "--output", metavar="FILE", help="write the report as JSON to FILE"
+    )
+    parser.add_argument(
+        "server_args", nargs="*", help="extra sftpserver options, after --"
+    )
+    args = parser.parse_args(argv)
+
+    args.ops, args.op_weights = parse_weights(args.mix)
+    unknown = set(args.ops) - set(OPERATIONS)
+    if unknown:
+        parser.error("unknown operations in --mix: %s" % ", ".join(sorted(unknown)))
+    args.sizes, args.size_weights = parse_weights(args.sizes, parse_size)
+    args.payload = os.urandom(max(args.sizes))
+
+    if args.target:
+        host, _, port = args.target.rpartition(":")
+
+        def connect():
+            transport = paramiko.Transport((host, int(port)))
+            transport.connect(username=args.username, password=args.password)
+            return transport, paramiko.SFTPClient.from_transport(transport)
+
+        def seed(key, data):
+            transport, sftp = connect()
+            try:
+                sftp.putfo(io.BytesIO(data), "/%s/%s" % (BUCKET, key), len(data))
+            finally:
+                transport.close()
+
+        report = run(args, connect, seed)
+    else:
+        fake = FakeS3Server().start()
+        fake.create_bucket(BUCKET)
+        server_args = ["--max-sessions", str(args.clients)] + args.server_args
+        with tempfile.TemporaryDirectory() as workdir:
+            server = ServerProcess(fake, workdir, server_args).wait_ready()
+            try:
+                report = run(
+                    args,
+                    server.client,
+                    lambda key, data: fake.put_object(BUCKET, key, data),
+                )
+            finally:
+                server.stop()
+                fake.stop()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Local filesystem storage backend.
+
+Buckets are the directories of ``root`` and keys are paths below them,
+so ``a/b/c`` is the file ``root/bucket/a/b/c`` and every directory
+doubles as the directory marker key ``a/b/``.  Writes go to a temporary
+file first and are renamed into place, so readers never see a partial
+object.  ETags are derived from the file's mtime and size rather than
+its content, which keeps listings and stats free of I/O on file data.
+For the same reason the checksums passed to ``put`` are verified against
+the data written but not kept, so ``head`` reports none.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+
+from helper.debug import function_debuger
+
+from .checksum import Checksums, available, multipart_etag
+from .storage import (
+    DIRECTORY,
+    FILE,
+    ListPage,
+    ObjectInfo,
+    StorageBackend,
+    no_such_file,
+    paginate,
+)
+
+TEMP_PREFIX = ".sftp-tmp-"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def stat_etag(st):
+    return "%x-%x" % (st.st_mtime_ns, st.st_size)
+
+
+class LocalBackend(StorageBackend):
+    """Storage backend on a local directory tree."""
+
+    # ETags come from stat, not from the file's content.
+    md5_etags = False
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _bucket_path(self, bucket_name):
+        if not bucket_name or bucket_name in (".", "..") or "/" in bucket_name:
+            raise OSError(errno.EINVAL, "Invalid bucket name", bucket_name)
+        return os.path.join(self.root, bucket_name)
+
+    def _path(self, bucket_name, key_name):
+        parts = key_name.rstrip("/").split("/")
+        if any(part in ("", ".", "..") for part in parts) or any(
+            part.startswith(TEMP_PREFIX) for part in parts
+        ):
+            raise OSError(errno.EINVAL, "Invalid key name", key_name)
+        return os.path.join(self._bucket_path(bucket_name), *parts)
+
+    def _temp_path(self, bucket_name, suffix=None):
+        name = TEMP_PREFIX + (suffix or uuid.uuid4().hex)
+        return os.path.join(self._bucket_path(bucket_name), name)
+
+    def _check_bucket(self, bucket_name):
+        if not os.path.isdir(self._bucket_path(bucket_name)):
+            raise no_such_file(bucket_name)
+
+    def _info(self, key_name, st, is_dir):
+        if is_dir:
+            return ObjectInfo(key_name, 0, int(st.st_mtime), "", DIRECTORY)
+        return ObjectInfo(
+            key_name, st.st_size, int(st.st_mtime), stat_etag(st), FILE
+        )
+
+    def _store(self, bucket_name, key_name, source):
+        """Move the temporary file ``source`` into place as ``key_name``."""
+        path = self._path(bucket_name, key_name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source, path)
+        except OSError:
+            os.remove(source)
+            raise
+        return stat_etag(os.stat(path))
+
+    @function_debuger
+    def list_buckets(self):
+        return sorted(
+            entry.name for entry in os.scandir(self.root) if entry.is_dir()
+        )
+
+    @function_debuger
+    def bucket_exists(self, bucket_name):
+        return os.path.isdir(self._bucket_path(bucket_name))
+
+    @function_debuger
+    def create_bucket(self, bucket_name):
+        os.makedirs(self._bucket_path(bucket_name), exist_ok=True)
+
+    @function_debuger
+    def delete_bucket(self, bucket_name):
+        self._check_bucket(bucket_name)
+        os.rmdir(self._bucket_path(bucket_name))
+
+    @function_debuger
+    def head(self, bucket_name, key_name):
+        self._check_bucket(bucket_name)
+        try:
+            st = os.stat(self._path(bucket_name, key_name))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        is_dir = os.path.isdir(self._path(bucket_name, key_name))
+        if is_dir != key_name.endswith("/"):
+            return None
+        return self._info(key_name, st, is_dir)
+
+    def _walk(self, directory, base, recursive):
+        """Yield ``(key name, ObjectInfo)`` below ``directory`` in key order."""
+        try:
+            entries = [
+                entry
+                for entry in os.scandir(directory)
+                if not entry.name.startswith(TEMP_PREFIX)
+            ]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        named = sorted(
+            (base + entry.name + ("/" if entry.is_dir() else ""), entry)
+            for entry in entries
+        )
+        for key_name, entry in named:
+            is_dir = key_name.endswith("/")
+            try:
+                info = self._info(key_name, entry.stat(), is_dir)
+            except FileNotFoundError:
+                continue
+            yield key_name, info
+            if is_dir and recursive:
+                yield from self._walk(entry.path, key_name, recursive)
+
+    @function_debuger
+    def list(self, bucket_name, prefix="", delimiter="", marker="", max_keys=1000):
+        self._check_bucket(bucket_name)
+        base = prefix[: prefix.rfind("/") + 1]
+        directory = self._bucket_path(bucket_name)
+        if base:
+            directory = self._path(bucket_name, base)
+        infos = {}
+
+        def names():
+            if base and base == prefix and os.path.isdir(directory):
+                st = os.stat(directory)
+                infos[base] = self._info(base, st, True)
+                yield base
+            for key_name, info in self._walk(directory, base, delimiter != "/"):
+                infos.clear()
+                infos[key_name] = info
+                yield key_name
+
+        entries = []
+        next_marker = None
+        for name, is_prefix in paginate(names(), prefix, delimiter, marker, max_keys):
+            if name is None:
+                next_marker = is_prefix
+            elif is_prefix:
+                entries.append(ObjectInfo(name, 0, 0, "", DIRECTORY))
+            else:
+                entries.append(infos[name])
+        return ListPage(entries, next_marker)
+
+    @function_debuger
+    def get_range(self, bucket_name, key_name, start, end, etag=None):
+        self._check_bucket(bucket_name)
+        try:
+            f = open(self._path(bucket_name, key_name), "rb")
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise no_such_file(key_name)
+        with f:
+            if etag and etag != stat_etag(os.fstat(f.fileno())):
+                raise OSError(errno.ESTALE, "Object changed", key_name)
+            f.seek(start)
+            return f.read(end - start)
+
+    @function_debuger
+    def put(self, bucket_name, key_name, body, checksums=None):
+        self._check_bucket(bucket_name)
+        if key_name.endswith("/"):
+            os.makedirs(self._path(bucket_name, key_name), exist_ok=True)
+            return ""
+        expected = {
+            name: hexdigest
+            for name, hexdigest in (checksums or {}).items()
+            if available(name)
+        }
+        digests = Checksums(list(expected)) if expected else None
+        temp = self._temp_path(bucket_name)
+        try:
+            with open(temp, "wb") as f:
+                if isinstance(body, (bytes, bytearray)):
+                    chunks = [body]
+                else:
+                    chunks = iter(lambda: body.read(COPY_BUFFER_SIZE), b"")
+                for chunk in chunks:
+                    if digests is not None:
+                        digests.update(chunk)
+                    f.write(chunk)
+            if digests is not None and digests.hexdigests() != expected:
+                raise OSError(errno.EIO, "Checksum mismatch", key_name)
+        except BaseException:
+            os.remove(temp)
+            raise
+        return self._store(bucket_name, key_name, temp)
+
+    @function_debuger
+    def start_multipart(self, bucket_name, key_name, checksums=None):
+        self._check_bucket(bucket_name)
+        return uuid.uuid4().hex
+
+    @function_debuger
+    def upload_part(self, bucket_name, key_name, upload_id, part_num, data, md5=None):
+        part = self._temp_path(bucket_name, "%s-%d" % (upload_id, part_num))
+        with open(part, "wb") as f:
+            f.write(data)
+        return md5 or hashlib.md5(data).hexdigest()
+
+    @function_debuger
+    def complete_multipart(self, bucket_name, key_name, upload_id, etags):
+        temp = self._temp_path(bucket_name)
+        with open(temp, "wb") as f:
+            for part_num in sorted(etags):
+                part = self._temp_path(bucket_name, "%s-%d" % (upload_id, part_num))
+                try:
+                    with open(part, "rb") as source:
+                        shutil.copyfileobj(source, f)
+                except FileNotFoundError:
+                    os.remove(temp)
+                    raise no_such_file(key_name)
+        self.abort_multipart(bucket_name, key_name, upload_id)
+        self._store(bucket_name, key_name, temp)
+        return multipart_etag([etags[n] for n in sorted(etags)])
+
+    @function_debuger
+    def abort_multipart(self, bucket_name, key_name, upload_id):
+        prefix = TEMP_PREFIX + upload_id + "-"
+        for entry in os.scandir(self._bucket_path(bucket_name)):
+            if entry.name.startswith(prefix):
+                os.remove(entry.path)
+
+    @function_debuger
+    def copy(
+        self, bucket_name, key_name, dest_bucket_name, dest_key_name, size=None
+    ):
+        self._check_bucket(dest_bucket_name)
+        if key_name.endswith("/"):
+            if self.head(bucket_name, key_name) is None:
+                raise no_such_file(key_name)
+            return self.put(dest_bucket_name, dest_key_name, b"")
+        temp = self._temp_path(dest_bucket_name)
+        try:
+            shutil.copyfile(self._path(bucket_name, key_name), temp)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise no_such_file(key_name)
+        return self._store(dest_bucket_name, dest_key_name, temp)
+
+    @function_debuger
+    def delete(self, bucket_name, key_name):
+        self._check_bucket(bucket_name)
+        path = self._path(bucket_name, key_name)
+        try:
+            if key_name.endswith("/"):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            pass
+        except OSError as e:
+            # A directory with keys below it still exists implicitly, as
+            # it would on S3 once its marker is gone.
+            if e.errno != errno.ENOTEMPTY:
+                raise
+
+    @function_debuger
+    def delete_many(self, bucket_name, key_names):
+        errors = {}
+        # Deepest keys first, so directories are empty by the time their
+        # marker is deleted.
+        for key_name in sorted(key_names, reverse=True):
+            try:
+                self.delete(bucket_name, key_name)
+            except OSError as e:
+                errors[key_name] = e.strerror
+        return errors
+
+    def __repr__(self):
+        return "LocalBackend(%r)" % self.root
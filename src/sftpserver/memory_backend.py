@@ -0,0 +1,223 @@
+"""
+In-memory storage backend.
+
+Objects live in a process-wide dict, shared by every session, and are
+gone when the process exits.  It has the listing semantics of S3 but
+none of its latency, which makes it the baseline for benchmarking the
+SFTP layer itself.
+"""
+
+import bisect
+import errno
+import hashlib
+import threading
+import time
+import uuid
+
+from helper.debug import function_debuger
+
+from .checksum import multipart_etag
+from .storage import (
+    DIRECTORY,
+    FILE,
+    ListPage,
+    ObjectInfo,
+    StorageBackend,
+    no_such_file,
+    paginate,
+)
+
+
+class MemoryBucket(object):
+    __slots__ = ("objects", "names")
+
+    def __init__(self):
+        # key name -> (data, ObjectInfo)
+        self.objects = {}
+        # Key names in sorted order, for listings.
+        self.names = []
+
+    def store(self, key_name, data, etag=None, checksums=None):
+        if key_name not in self.objects:
+            bisect.insort(self.names, key_name)
+        info = ObjectInfo(
+            key_name,
+            len(data),
+            int(time.time()),
+            etag or hashlib.md5(data).hexdigest(),
+            DIRECTORY if key_name.endswith("/") else FILE,
+            dict(checksums or {}),
+        )
+        self.objects[key_name] = (data, info)
+        return info.etag
+
+    def remove(self, key_name):
+        if self.objects.pop(key_name, None) is not None:
+            del self.names[bisect.bisect_left(self.names, key_name)]
+
+
+class MemoryBackend(StorageBackend):
+    """Storage backend keeping every object in memory."""
+
+    _lock = threading.Lock()
+    _buckets = {}
+    # upload id -> ({part number: (data, ETag)}, checksums)
+    _uploads = {}
+
+    @classmethod
+    def reset(cls):
+        """Forget every bucket and object."""
+        with cls._lock:
+            cls._buckets.clear()
+            cls._uploads.clear()
+
+    def _bucket(self, bucket_name):
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            raise no_such_file(bucket_name)
+        return bucket
+
+    def _object(self, bucket_name, key_name):
+        entry = self._bucket(bucket_name).objects.get(key_name)
+        if entry is None:
+            raise no_such_file(key_name)
+        return entry
+
+    @function_debuger
+    def list_buckets(self):
+        with self._lock:
+            return sorted(self._buckets)
+
+    @function_debuger
+    def bucket_exists(self, bucket_name):
+        return bucket_name in self._buckets
+
+    @function_debuger
+    def create_bucket(self, bucket_name):
+        with self._lock:
+            self._buckets.setdefault(bucket_name, MemoryBucket())
+
+    @function_debuger
+    def delete_bucket(self, bucket_name):
+        with self._lock:
+            if self._bucket(bucket_name).objects:
+                raise OSError(errno.ENOTEMPTY, "Bucket not empty", bucket_name)
+            del self._buckets[bucket_name]
+
+    @function_debuger
+    def head(self, bucket_name, key_name):
+        with self._lock:
+            entry = self._bucket(bucket_name).objects.get(key_name)
+        return entry[1] if entry is not None else None
+
+    @function_debuger
+    def list(self, bucket_name, prefix="", delimiter="", marker="", max_keys=1000):
+        with self._lock:
+            bucket = self._bucket(bucket_name)
+            names = bucket.names
+            start = max(
+                bisect.bisect_left(names, prefix), bisect.bisect_right(names, marker)
+            )
+            entries = []
+            next_marker = None
+            for name, is_prefix in paginate(
+                (names[i] for i in range(start, len(names))),
+                prefix,
+                delimiter,
+                marker,
+                max_keys,
+            ):
+                if name is None:
+                    next_marker = is_prefix
+                elif is_prefix:
+                    entries.append(ObjectInfo(name, 0, 0, "", DIRECTORY))
+                else:
+                    entries.append(bucket.objects[name][1])
+        return ListPage(entries, next_marker)
+
+    @function_debuger
+    def get_range(self, bucket_name, key_name, start, end, etag=None):
+        with self._lock:
+            data, info = self._object(bucket_name, key_name)
+        if etag and etag != info.etag:
+            raise OSError(errno.ESTALE, "Object changed", key_name)
+        return data[start:end]
+
+    @function_debuger
+    def put(self, bucket_name, key_name, body, checksums=None):
+        if not isinstance(body, (bytes, bytearray)):
+            body = body.read()
+        etag = hashlib.md5(body).hexdigest()
+        if checksums and checksums.get("md5", etag) != etag:
+            raise OSError(errno.EIO, "Content-MD5 mismatch", key_name)
+        with self._lock:
+            return self._bucket(bucket_name).store(
+                key_name, bytes(body), etag, checksums
+            )
+
+    @function_debuger
+    def start_multipart(self, bucket_name, key_name, checksums=None):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._bucket(bucket_name)
+            self._uploads[upload_id] = ({}, checksums)
+        return upload_id
+
+    @function_debuger
+    def upload_part(self, bucket_name, key_name, upload_id, part_num, data, md5=None):
+        etag = md5 or hashlib.md5(data).hexdigest()
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                raise no_such_file(key_name)
+            upload[0][part_num] = (bytes(data), etag)
+        return etag
+
+    @function_debuger
+    def complete_multipart(self, bucket_name, key_name, upload_id, etags):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+            if upload is None:
+                raise no_such_file(key_name)
+            parts, checksums = upload
+            numbers = sorted(etags)
+            if any(parts.get(n, (None, None))[1] != etags[n] for n in numbers):
+                raise OSError(errno.EIO, "Invalid part list", key_name)
+            data = b"".join(parts[n][0] for n in numbers)
+            return self._bucket(bucket_name).store(
+                key_name,
+                data,
+                multipart_etag([etags[n] for n in numbers]),
+                checksums,
+            )
+
+    @function_debuger
+    def abort_multipart(self, bucket_name, key_name, upload_id):
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+    @function_debuger
+    def copy(
+        self, bucket_name, key_name, dest_bucket_name, dest_key_name, size=None
+    ):
+        with self._lock:
+            data, info = self._object(bucket_name, key_name)
+            return self._bucket(dest_bucket_name).store(
+                dest_key_name, data, info.etag, info.checksums
+            )
+
+    @function_debuger
+    def delete(self, bucket_name, key_name):
+        with self._lock:
+            self._bucket(bucket_name).remove(key_name)
+
+    @function_debuger
+    def delete_many(self, bucket_name, key_names):
+        with self._lock:
+            bucket = self._bucket(bucket_name)
+            for key_name in key_names:
+                bucket.remove(key_name)
+        return {}
+
+    def __repr__(self):
+        return "MemoryBackend()"
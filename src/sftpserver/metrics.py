@@ -0,0 +1,239 @@
+"""
+Process metrics in the Prometheus text exposition format.
+
+Counters, gauges and latency histograms are kept in memory and served by
+:func:`start_metrics_server` on ``/metrics``.  Values that already live
+elsewhere (cache hit counters, ...) are read at scrape time through
+:class:`CallbackGauge`.
+"""
+
+import bisect
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helper.logger import logger
+from paramiko.sftp import SFTP_OK
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames and self.kind in ("counter", "gauge"):
+            # Export unlabelled series from the start rather than on first use.
+            self._values[()] = 0
+        registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("%s expects labels %s" % (self.name, self.labelnames))
+        return tuple(labels)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in sorted(items):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class CallbackGauge(Metric):
+    """A gauge (or counter) whose value is computed when scraped."""
+
+    def __init__(self, name, documentation, callback, kind="gauge"):
+        super(CallbackGauge, self).__init__(name, documentation)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        with self._lock:
+            items = [
+                (labels, (list(entry[0]), entry[1], entry[2]))
+                for labels, entry in self._values.items()
+            ]
+        for labels, (counts, count, total) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield (
+                    self.name + "_bucket",
+                    _format_labels(
+                        self.labelnames, labels, [("le", _format_value(bound))]
+                    ),
+                    cumulative,
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            yield self.name + "_count", label_text, count
+            yield self.name + "_sum", label_text, total
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+sessions_active = Gauge("sftp_sessions_active", "SSH sessions currently open.")
+sessions_total = Counter("sftp_sessions_total", "SSH sessions accepted.")
+operations_total = Counter(
+    "sftp_operations_total", "SFTP operations served.", ["op"]
+)
+operation_errors_total = Counter(
+    "sftp_operation_errors_total", "SFTP operations that raised.", ["op"]
+)
+operation_seconds = Histogram(
+    "sftp_operation_duration_seconds", "Latency of SFTP operations.", ["op"]
+)
+s3_requests_total = Counter(
+    "s3_requests_total", "Requests sent to S3 by HTTP verb.", ["verb"]
+)
+bytes_received_total = Counter(
+    "sftp_bytes_received_total", "File bytes written by clients."
+)
+bytes_sent_total = Counter("sftp_bytes_sent_total", "File bytes read by clients.")
+upload_parts_in_flight = Gauge(
+    "s3_upload_parts_in_flight", "Multipart upload parts queued or uploading."
+)
+
+
+def timed(op):
+    """Count and time calls of an SFTP operation under the ``op`` label.
+
+    Errors are calls that raise or that return an SFTP status other than
+    ``SFTP_OK``, as ``read``, ``write`` and ``stat`` report failures.
+    """
+
+    labels = (op,)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                operation_errors_total.inc(labels=labels)
+                raise
+            else:
+                if (
+                    isinstance(result, int)
+                    and not isinstance(result, bool)
+                    and result != SFTP_OK
+                ):
+                    operation_errors_total.inc(labels=labels)
+                return result
+            finally:
+                operations_total.inc(labels=labels)
+                operation_seconds.observe(time.perf_counter() - start, labels)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+def start_metrics_server(host, port):
+    """Serve ``/metrics`` from a daemon thread and return the server."""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(
+        target=httpd.serve_forever, name="metrics", daemon=True
+    )
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return httpd
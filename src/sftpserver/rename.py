@@ -0,0 +1,90 @@
+"""
+Server-side rename.
+
+Object stores cannot rename: a key is moved by copying it within the
+store and deleting the original, so no file data passes through the
+server.  A virtual directory is moved key by key, with up to
+``COPY_CONCURRENCY`` copies in flight, and its old keys are only deleted
+once every copy succeeded, in batches (see :mod:`sftpserver.bulk`).
+"""
+
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from helper.debug import function_debuger
+from helper.logger import logger
+
+from . import settings
+from .bulk import delete_keys, iter_keys, report_errors
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.COPY_WORKERS, thread_name_prefix="rename"
+)
+
+
+@function_debuger
+def move_object(
+    storage, bucket_name, key_name, dest_bucket_name, dest_key_name, size=None
+):
+    storage.copy(bucket_name, key_name, dest_bucket_name, dest_key_name, size)
+    storage.delete(bucket_name, key_name)
+    storage.invalidate_object(bucket_name, key_name)
+    storage.invalidate_object(dest_bucket_name, dest_key_name)
+
+
+@function_debuger
+def move_directory(storage, bucket_name, prefix, dest_bucket_name, dest_prefix):
+    """Move every key below ``prefix`` to ``dest_prefix``.
+
+    Returns the number of keys moved.  If a copy fails no source key is
+    deleted, the copies made so far are, and ``EIO`` is raised, so the
+    rename can be retried.
+    """
+    slots = threading.BoundedSemaphore(settings.COPY_CONCURRENCY)
+    failures = []
+    moved = []
+    copied = []
+
+    def copy(info):
+        try:
+            dest_key_name = dest_prefix + info.name[len(prefix) :]
+            storage.copy(
+                bucket_name, info.name, dest_bucket_name, dest_key_name, info.size
+            )
+            storage.invalidate_object(dest_bucket_name, dest_key_name)
+            copied.append(dest_key_name)
+        except Exception as e:
+            logger.error("Could not copy %s: %s", info.name, e)
+            failures.append(info.name)
+        finally:
+            slots.release()
+
+    futures = []
+    for info in iter_keys(storage, bucket_name, prefix):
+        if failures:
+            break
+        slots.acquire()
+        futures.append(_executor.submit(copy, info))
+        moved.append(info.name)
+    for future in futures:
+        future.result()
+    if failures:
+        errors = delete_keys(storage, dest_bucket_name, copied)
+        storage.invalidate_object(dest_bucket_name, dest_prefix, dest_prefix[:-1])
+        for name, error in sorted(errors.items()):
+            logger.error("Could not delete the copy %s: %s", name, error)
+        raise OSError(
+            errno.EIO,
+            "Could not copy %d keys of %s, the source was left as it was"
+            % (len(failures), prefix),
+        )
+
+    errors = delete_keys(storage, bucket_name, moved)
+    storage.invalidate_object(
+        bucket_name, prefix, prefix[:-1], *(name.rstrip("/") for name in moved)
+    )
+    storage.invalidate_object(dest_bucket_name, dest_prefix, dest_prefix[:-1])
+    if errors:
+        report_errors(errors, "Copied %s" % prefix)
+    return len(moved)
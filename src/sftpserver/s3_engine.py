@@ -0,0 +1,245 @@
+"""
+Asynchronous S3 I/O engine.
+
+One asyncio event loop, on its own thread, sends the S3 requests of
+every session over a shared pool of keep-alive HTTP connections.
+Callers get a ``concurrent.futures.Future`` back, so a session can have
+many requests in flight, and thousands of requests can be outstanding
+process-wide, without a thread for each of them.
+
+Requests are built and signed by the session's boto connection, exactly
+as boto would send them; the engine only moves the bytes.  Responses
+with an error status raise boto's ``S3ResponseError``, and transport
+failures ``ConnectionError``, so callers handle both like boto calls.
+"""
+
+import asyncio
+import os
+import ssl
+import threading
+import time
+from collections import namedtuple
+
+from helper.logger import logger
+
+from . import metrics, settings
+
+# Statuses worth sending the request again for.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+Response = namedtuple("Response", "status reason headers body")
+
+
+class _Endpoint(object):
+    """Idle keep-alive connections to one ``(host, port, secure)``."""
+
+    __slots__ = ("host", "port", "secure", "idle")
+
+    def __init__(self, host, port, secure):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        # (reader, writer, last used) tuples, most recently used last.
+        self.idle = []
+
+
+def _split_host(host, port):
+    if ":" in host:
+        host, _, port = host.rpartition(":")
+    return host, int(port)
+
+
+async def _read_body(reader, headers, method, status):
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        return b""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    # No framing: the body runs until the server closes the connection.
+    headers["connection"] = "close"
+    return await reader.read()
+
+
+async def _read_response(reader, method):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("Connection closed by S3")
+    parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    status = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ""
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await _read_body(reader, headers, method, status)
+    return Response(status, reason, headers, body)
+
+
+class S3Engine(object):
+    """Event loop and HTTP connection pool shared by every session.
+
+    The loop thread starts on first use, and again in a forked worker.
+    At most ``max_connections`` connections are open at a time; requests
+    beyond that wait for one to be free, not for a thread.
+    """
+
+    def __init__(self, max_connections=None, timeout=None, retries=None):
+        self.max_connections = max_connections or settings.S3_ENGINE_CONNECTIONS
+        self.timeout = timeout or settings.S3_ENGINE_TIMEOUT
+        self.retries = settings.S3_ENGINE_RETRIES if retries is None else retries
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._endpoints = {}
+        self._slots = None
+        self._ssl = None
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="s3-engine", daemon=True
+            )
+            thread.start()
+            self._loop = loop
+            self._pid = os.getpid()
+            self._endpoints = {}
+            self._slots = None
+            return loop
+
+    def submit(
+        self,
+        connection,
+        method,
+        bucket_name="",
+        key_name="",
+        headers=None,
+        data=b"",
+        query_args=None,
+    ):
+        """Send a request built by the boto ``connection``.
+
+        Returns a ``concurrent.futures.Future`` of a :data:`Response`.
+        Statuses of 300 and above fail with ``S3ResponseError``.
+        """
+        calling_format = connection.calling_format
+        path = calling_format.build_path_base(bucket_name, key_name)
+        auth_path = calling_format.build_auth_path(bucket_name, key_name)
+        host = calling_format.build_host(connection.server_name(), bucket_name)
+        if query_args:
+            path += "?" + query_args
+            auth_path += "?" + query_args
+        request = connection.build_base_http_request(
+            method, path, auth_path, {}, headers, data, host
+        )
+        request.authorize(connection=connection)
+        metrics.s3_requests_total.inc(labels=(method,))
+        coroutine = self._perform(
+            request, connection.is_secure, connection.provider.storage_response_error
+        )
+        return asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop())
+
+    async def _perform(self, request, secure, response_error):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        host, port = _split_host(request.host, request.port)
+        key = (host, port, secure)
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = self._endpoints[key] = _Endpoint(host, port, secure)
+        head = self._head(request, host, port, secure)
+
+        attempt = 0
+        while True:
+            async with self._slots:
+                try:
+                    response = await asyncio.wait_for(
+                        self._exchange(endpoint, request, head), self.timeout
+                    )
+                except (OSError, EOFError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries:
+                        if isinstance(e, OSError):
+                            raise
+                        raise ConnectionError("S3 request failed: %r" % e)
+                    logger.warning("Retrying S3 %s: %r", request.method, e)
+                    response = None
+            if response is not None:
+                if response.status < 300:
+                    return response
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise response_error(
+                        response.status, response.reason, response.body
+                    )
+            attempt += 1
+            await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+
+    def _head(self, request, host, port, secure):
+        headers = dict(request.headers)
+        if not any(name.lower() == "host" for name in headers):
+            default = 443 if secure else 80
+            headers["Host"] = host if port == default else "%s:%d" % (host, port)
+        lines = ["%s %s HTTP/1.1" % (request.method, request.path)]
+        lines.extend("%s: %s" % item for item in headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _open(self, endpoint):
+        context = None
+        if endpoint.secure:
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        return await asyncio.open_connection(
+            endpoint.host, endpoint.port, ssl=context, limit=1024 * 1024
+        )
+
+    async def _exchange(self, endpoint, request, head):
+        now = time.monotonic()
+        reused = False
+        reader = writer = None
+        while endpoint.idle:
+            reader, writer, last_used = endpoint.idle.pop()
+            if now - last_used < settings.S3_POOL_MAX_IDLE and not reader.at_eof():
+                reused = True
+                break
+            writer.close()
+            reader = writer = None
+        if writer is None:
+            reader, writer = await self._open(endpoint)
+        try:
+            writer.write(head)
+            if request.body:
+                writer.write(request.body)
+            await writer.drain()
+            response = await _read_response(reader, request.method)
+        except (OSError, EOFError):
+            writer.close()
+            if reused:
+                # The server may have closed the idle connection as we
+                # reused it; a fresh connection gets one more chance.
+                return await self._exchange(endpoint, request, head)
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        if response.headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            endpoint.idle.append((reader, writer, time.monotonic()))
+        return response
+
+
+engine = S3Engine()
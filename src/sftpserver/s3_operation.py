@@ -1,29 +1,513 @@
-from boto.exception import S3CreateError, S3ResponseError
-from boto.s3.connection import S3Connection
+import base64
+import calendar
+import errno
+import hashlib
+import io
+import socket
+import threading
+import xml.sax
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from http.client import HTTPException
+
+from boto import handler
+from boto.exception import S3DataError, S3ResponseError
+from boto.resultset import ResultSet
+from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.s3.prefix import Prefix
+from boto.utils import parse_ts
 from helper.debug import function_debuger
 from helper.logger import logger
 
+from . import checksum, settings
+from .connection_pool import pool
+from .s3_engine import engine
+from .storage import DIRECTORY, FILE, ListPage, ObjectInfo, StorageBackend
+
+CONNECTION_ERRORS = (socket.error, HTTPException)
+
+# Buckets known to exist, per access key, shared by every session of the
+# process.  Only names are kept: a Bucket object is bound to the
+# connection of the session that resolved it.
+_known_buckets = set()
+_known_buckets_lock = threading.Lock()
+
+# S3 refuses to copy objects larger than this in a single request.
+MAX_COPY_SIZE = 5 * 1024 ** 3
+# Nor accepts parts, but the last, smaller than this.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+_copy_executor = ThreadPoolExecutor(
+    max_workers=settings.COPY_WORKERS, thread_name_prefix="s3-copy"
+)
+
+# errno reported for S3 error statuses, EIO for the others.
+STATUS_ERRNO = {
+    403: errno.EACCES,
+    404: errno.ENOENT,
+    409: errno.ENOTEMPTY,
+    412: errno.ESTALE,
+    416: errno.EINVAL,
+}
+
+
+def parse_mtime(value):
+    """Seconds since the epoch from a HEAD (RFC 1123) or LIST (ISO 8601) date."""
+    if not value:
+        return 0
+    try:
+        if value[0].isdigit():
+            return calendar.timegm(parse_ts(value).timetuple())
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def head_info(key_name, response):
+    """``ObjectInfo`` from the headers of a HEAD response."""
+    headers = response.headers
+    metadata = {
+        name[len("x-amz-meta-") :]: value
+        for name, value in headers.items()
+        if name.startswith("x-amz-meta-")
+    }
+    return ObjectInfo(
+        key_name,
+        int(headers.get("content-length") or 0),
+        parse_mtime(headers.get("last-modified")),
+        headers.get("etag", "").strip('"'),
+        DIRECTORY if key_name.endswith("/") else FILE,
+        checksum.from_metadata(metadata),
+    )
+
+
+def response_etag(response):
+    return response.headers.get("etag", "").strip('"')
+
+
+def list_page(page):
+    """:class:`ListPage` of a boto listing ``ResultSet``.
+
+    S3 lists the keys of a page before its common prefixes; the entries
+    are merged back into key order.
+    """
+    entries = sorted(
+        (object_info(entry) for entry in page), key=lambda info: info.name
+    )
+    next_marker = None
+    if page.is_truncated and entries:
+        next_marker = page.next_marker or entries[-1].name
+    return ListPage(entries, next_marker)
+
+
+def object_info(key):
+    """Compact, cacheable metadata of a boto ``Key`` or listing ``Prefix``."""
+    return ObjectInfo(
+        key.name,
+        getattr(key, "size", 0) or 0,
+        parse_mtime(getattr(key, "last_modified", None)),
+        (getattr(key, "etag", None) or "").strip('"'),
+        DIRECTORY if key.name.endswith("/") else FILE,
+    )
+
 
-class S3Operation(object):
-    """Storing connection object."""
+class S3Operation(StorageBackend):
+    """Storage backend on S3, through a pooled boto connection."""
 
     @function_debuger
     def __init__(self, key, secret, username=None):
         self.username = username or key
         self.key = key
         self._secret = secret
-        self.connection = S3Connection(
-            aws_access_key_id=key, aws_secret_access_key=secret
-        )
+        self.connection = pool.get(key, secret)
+        self._buckets = {}
+        self.engine = engine if settings.S3_ENGINE == "async" else None
 
     @function_debuger
-    def get_all_buckets(self):
+    def reconnect(self):
+        """Drop a connection that failed at the transport level."""
+        pool.discard(self.connection)
+        self.connection = pool.get(self.key, self._secret)
+        self._buckets.clear()
+
+    def _error(self, e, name):
+        """The ``OSError`` reported for a boto or connection error."""
+        if isinstance(e, S3ResponseError):
+            code = STATUS_ERRNO.get(e.status, errno.EIO)
+            if code != errno.ENOENT:
+                logger.error("S3 error on %s: %s %s", name, e.status, e.reason)
+            return OSError(code, "S3 error: %s %s" % (e.status, e.reason), name)
+        logger.error("S3 connection error on %s: %r", name, e)
+        return OSError(errno.EIO, "S3 connection error: %s" % e, name)
+
+    @contextmanager
+    def _errors(self, name=None):
+        """Translate boto and socket errors into ``OSError``."""
         try:
-            return list(self.connection.get_all_buckets())
+            yield
         except S3ResponseError as e:
-            logger.exception(e)
-            raise OSError(1, "S3 error (probably bad credentials)" + str(e))
+            raise self._error(e, name)
+        except S3DataError as e:
+            # boto checks the ETag of uploads against their MD5 itself.
+            logger.error("S3 data error on %s: %s", name, e)
+            raise OSError(errno.EIO, "Checksum mismatch on upload", name)
+        except CONNECTION_ERRORS as e:
+            self.reconnect()
+            raise self._error(e, name)
+
+    def _submit(self, transform, name, method, bucket_name, key_name="", **kwargs):
+        """Send a request through the engine without waiting for it.
+
+        Returns a ``Future`` of ``transform(response)``; S3 and connection
+        errors fail it with ``OSError``.  Cancelling it cancels the request.
+        """
+        with self._errors(name):
+            self.get_bucket(bucket_name)
+        sent = self.engine.submit(
+            self.connection, method, bucket_name, key_name, **kwargs
+        )
+        result = Future()
+
+        def done(sent):
+            if sent.cancelled() or result.cancelled():
+                result.cancel()
+                return
+            try:
+                value = transform(sent.result())
+            except (S3ResponseError,) + CONNECTION_ERRORS as e:
+                error, value = self._error(e, name), None
+            except Exception as e:
+                error, value = e, None
+            else:
+                error = None
+            try:
+                if error is None:
+                    result.set_result(value)
+                else:
+                    result.set_exception(error)
+            except InvalidStateError:
+                pass
+
+        result.add_done_callback(lambda result: result.cancelled() and sent.cancel())
+        sent.add_done_callback(done)
+        return result
+
+    @function_debuger
+    def get_bucket(self, name):
+        """Resolve a boto ``Bucket``, validating it only the first time.
+
+        Raises ``S3ResponseError`` when the bucket does not exist.
+        """
+        known = (self.key, name) in _known_buckets
+        bucket = self._buckets.get(name)
+        if bucket is not None and known:
+            return bucket
+        bucket = self.connection.get_bucket(name, validate=not known)
+        with _known_buckets_lock:
+            _known_buckets.add((self.key, name))
+        self._buckets[name] = bucket
+        return bucket
+
+    @function_debuger
+    def invalidate_bucket(self, name):
+        with _known_buckets_lock:
+            _known_buckets.discard((self.key, name))
+        self._buckets.pop(name, None)
+
+    @function_debuger
+    def list_buckets(self):
+        with self._errors():
+            return [bucket.name for bucket in self.connection.get_all_buckets()]
+
+    @function_debuger
+    def bucket_exists(self, bucket_name):
+        try:
+            with self._errors(bucket_name):
+                self.get_bucket(bucket_name)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    @function_debuger
+    def create_bucket(self, bucket_name):
+        self.invalidate_bucket(bucket_name)
+        with self._errors(bucket_name):
+            self.connection.create_bucket(bucket_name)
+
+    @function_debuger
+    def delete_bucket(self, bucket_name):
+        self.invalidate_bucket(bucket_name)
+        with self._errors(bucket_name):
+            self.connection.delete_bucket(bucket_name)
+
+    @function_debuger
+    def head(self, bucket_name, key_name):
+        if self.engine is not None:
+            try:
+                return self._submit(
+                    lambda response: head_info(key_name, response),
+                    key_name,
+                    "HEAD",
+                    bucket_name,
+                    key_name,
+                ).result()
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+        with self._errors(key_name):
+            key = self.get_bucket(bucket_name).get_key(key_name)
+        if key is None:
+            return None
+        return object_info(key)._replace(checksums=checksum.from_metadata(key.metadata))
+
+    @function_debuger
+    def list(self, bucket_name, prefix="", delimiter="", marker="", max_keys=1000):
+        if self.engine is not None:
+            with self._errors(prefix):
+                bucket = self.get_bucket(bucket_name)
+            query_args = bucket._get_all_query_args(
+                {
+                    "prefix": prefix,
+                    "delimiter": delimiter,
+                    "marker": marker,
+                    "max_keys": max_keys,
+                }
+            )
+
+            def parse(response):
+                page = ResultSet([("Contents", Key), ("CommonPrefixes", Prefix)])
+                xml.sax.parseString(response.body, handler.XmlHandler(page, bucket))
+                return page
+
+            page = self._submit(
+                parse, prefix, "GET", bucket_name, query_args=query_args
+            ).result()
+            return list_page(page)
+        with self._errors(prefix):
+            page = self.get_bucket(bucket_name).get_all_keys(
+                prefix=prefix, delimiter=delimiter, marker=marker, max_keys=max_keys
+            )
+        return list_page(page)
+
+    @function_debuger
+    def get_range(self, bucket_name, key_name, start, end, etag=None):
+        if self.engine is not None:
+            return self.submit_get_range(
+                bucket_name, key_name, start, end, etag
+            ).result()
+        headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+        if etag:
+            headers["If-Match"] = '"%s"' % etag
+        with self._errors(key_name):
+            key = self.get_bucket(bucket_name).new_key(key_name)
+            return key.get_contents_as_string(headers=headers)
+
+    def submit_get_range(self, bucket_name, key_name, start, end, etag=None):
+        if self.engine is None:
+            return super(S3Operation, self).submit_get_range(
+                bucket_name, key_name, start, end, etag
+            )
+        headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+        if etag:
+            headers["If-Match"] = '"%s"' % etag
+        return self._submit(
+            lambda response: response.body,
+            key_name,
+            "GET",
+            bucket_name,
+            key_name,
+            headers=headers,
+        )
+
+    def _submit_put(self, bucket_name, key_name, data, query_args=None, headers=None):
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/octet-stream"
+        if "Content-MD5" not in headers:
+            headers["Content-MD5"] = content_md5(data)
+        return self._submit(
+            response_etag,
+            key_name,
+            "PUT",
+            bucket_name,
+            key_name,
+            headers=headers,
+            data=data,
+            query_args=query_args,
+        )
+
+    @function_debuger
+    def put(self, bucket_name, key_name, body, checksums=None):
+        headers = checksum.upload_headers(checksums or {})
+        if self.engine is not None and isinstance(body, (bytes, bytearray)):
+            return self._submit_put(
+                bucket_name, key_name, bytes(body), headers=headers
+            ).result()
+        # boto sends Content-MD5 itself, and only reads the body again to
+        # compute it when it is not given.
+        md5 = None
+        if "Content-MD5" in headers:
+            md5 = (checksums["md5"], headers.pop("Content-MD5"))
+        with self._errors(key_name):
+            key = self.get_bucket(bucket_name).new_key(key_name)
+            if isinstance(body, (bytes, bytearray)):
+                key.set_contents_from_string(bytes(body), headers=headers, md5=md5)
+            else:
+                key.set_contents_from_file(body, headers=headers, md5=md5)
+        return key.etag.strip('"')
+
+    def _multipart(self, bucket_name, key_name, upload_id):
+        upload = MultiPartUpload(self.get_bucket(bucket_name))
+        upload.key_name = key_name
+        upload.id = upload_id
+        return upload
+
+    @function_debuger
+    def start_multipart(self, bucket_name, key_name, checksums=None):
+        with self._errors(key_name):
+            return (
+                self.get_bucket(bucket_name)
+                .initiate_multipart_upload(key_name, metadata=checksums)
+                .id
+            )
+
+    @function_debuger
+    def upload_part(self, bucket_name, key_name, upload_id, part_num, data, md5=None):
+        if self.engine is not None:
+            return self.submit_upload_part(
+                bucket_name, key_name, upload_id, part_num, data, md5
+            ).result()
+        with self._errors(key_name):
+            upload = self._multipart(bucket_name, key_name, upload_id)
+            key = upload.upload_part_from_file(
+                io.BytesIO(data),
+                part_num,
+                md5=(md5, checksum.header_value(md5)) if md5 else None,
+            )
+        return key.etag.strip('"')
+
+    def submit_upload_part(
+        self, bucket_name, key_name, upload_id, part_num, data, md5=None
+    ):
+        if self.engine is None:
+            return super(S3Operation, self).submit_upload_part(
+                bucket_name, key_name, upload_id, part_num, data, md5
+            )
+        return self._submit_put(
+            bucket_name,
+            key_name,
+            bytes(data),
+            query_args="uploadId=%s&partNumber=%d" % (upload_id, part_num),
+            headers={"Content-MD5": checksum.header_value(md5)} if md5 else None,
+        )
+
+    @function_debuger
+    def complete_multipart(self, bucket_name, key_name, upload_id, etags):
+        parts = "".join(
+            '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>'
+            % (part_num, etags[part_num])
+            for part_num in sorted(etags)
+        )
+        with self._errors(key_name):
+            result = self.get_bucket(bucket_name).complete_multipart_upload(
+                key_name,
+                upload_id,
+                "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % parts,
+            )
+        return result.etag.strip('"')
+
+    @function_debuger
+    def abort_multipart(self, bucket_name, key_name, upload_id):
+        with self._errors(key_name):
+            self._multipart(bucket_name, key_name, upload_id).cancel_upload()
+
+    @function_debuger
+    def copy(
+        self, bucket_name, key_name, dest_bucket_name, dest_key_name, size=None
+    ):
+        if size is None:
+            info = self.head(bucket_name, key_name)
+            if info is None:
+                raise OSError(errno.ENOENT, "No such file or directory", key_name)
+            size = info.size
+        threshold = min(settings.MULTIPART_COPY_THRESHOLD, MAX_COPY_SIZE)
+        if size > threshold:
+            return self._multipart_copy(
+                bucket_name, key_name, dest_bucket_name, dest_key_name, size
+            )
+        with self._errors(key_name):
+            key = self.get_bucket(dest_bucket_name).copy_key(
+                dest_key_name, bucket_name, key_name
+            )
+        return key.etag.strip('"')
+
+    def _multipart_copy(
+        self, bucket_name, key_name, dest_bucket_name, dest_key_name, size
+    ):
+        """Copy a large object as parts (UploadPartCopy) in parallel."""
+        part_size = max(settings.COPY_PART_SIZE, MIN_PART_SIZE)
+        # S3 allows at most 10000 parts.
+        part_size = max(part_size, -(-size // 10000))
+        # UploadPartCopy does not carry the source's metadata over.
+        info = self.head(bucket_name, key_name)
+        if info is None:
+            raise OSError(errno.ENOENT, "No such file or directory", key_name)
+        upload_id = self.start_multipart(
+            dest_bucket_name, dest_key_name, info.checksums
+        )
+        slots = threading.BoundedSemaphore(settings.COPY_CONCURRENCY)
+        upload = self._multipart(dest_bucket_name, dest_key_name, upload_id)
+
+        def copy_part(part_num, start, end):
+            try:
+                with self._errors(key_name):
+                    key = upload.copy_part_from_key(
+                        bucket_name, key_name, part_num, start, end - 1
+                    )
+                return part_num, key.etag.strip('"')
+            finally:
+                slots.release()
+
+        futures = []
+        try:
+            for part_num, start in enumerate(range(0, size, part_size), 1):
+                slots.acquire()
+                end = min(start + part_size, size)
+                futures.append(_copy_executor.submit(copy_part, part_num, start, end))
+            etags = dict(future.result() for future in futures)
+            return self.complete_multipart(
+                dest_bucket_name, dest_key_name, upload_id, etags
+            )
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            try:
+                self.abort_multipart(dest_bucket_name, dest_key_name, upload_id)
+            except OSError as e:
+                logger.error("Could not abort copy to %s: %s", dest_key_name, e)
+            raise
+
+    @function_debuger
+    def delete(self, bucket_name, key_name):
+        with self._errors(key_name):
+            self.get_bucket(bucket_name).delete_key(key_name)
+
+    @function_debuger
+    def delete_many(self, bucket_name, key_names):
+        with self._errors(bucket_name):
+            result = self.get_bucket(bucket_name).delete_keys(
+                list(key_names), quiet=True
+            )
+        return {error.key: error.message or error.code for error in result.errors}
 
     @function_debuger
     def __repr__(self):
-        return self.connection
+        return "S3Operation(%r)" % self.username
@@ -0,0 +1,223 @@
+"""
+Concurrent SSH/SFTP session server.
+
+Every accepted connection gets its own session thread, bounded by
+``max_sessions``, so a slow client no longer holds up the accept loop.
+:class:`TransportOptions` sets up the SSH transport of each session:
+the algorithms offered and the channel window and packet sizes.
+"""
+
+import socket
+import threading
+import time
+
+import paramiko
+from helper.logger import logger
+
+from . import metrics, settings
+from .journal import start_journal, stop_journal
+from .stub_sftp import StubServer, StubSFTPServer
+
+BACKLOG = 10
+
+# Host key types tried in turn when loading a key file.
+HOST_KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+def load_host_key(keyfile):
+    """Parse a server host key once, it is shared by every session.
+
+    Ed25519, ECDSA and RSA keys are accepted.
+    """
+    error = None
+    for key_class in HOST_KEY_CLASSES:
+        try:
+            return key_class.from_private_key_file(keyfile, password="s")
+        except paramiko.SSHException as e:
+            error = e
+    raise error
+
+
+def load_host_keys(keyfiles):
+    """Load host keys of different types; clients pick the one they prefer."""
+    return [load_host_key(keyfile) for keyfile in keyfiles]
+
+
+def algorithms(value, supported, kind):
+    """A tuple of algorithm names from a comma separated string or a list.
+
+    Raises ``ValueError`` for names paramiko does not implement.
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    names = tuple(name.strip() for name in value if name.strip())
+    unknown = [name for name in names if name not in supported]
+    if unknown:
+        raise ValueError("Unsupported SSH %s: %s" % (kind, ", ".join(unknown)))
+    return names
+
+
+class TransportOptions(object):
+    """How the SSH transport of every session is set up.
+
+    Clients pick the first algorithm of their own preference list that
+    the server offers, so ``ciphers``, ``macs`` and ``kex`` restrict
+    what is offered, and an empty list offers all of paramiko's.  At most
+    ``window_size`` bytes are sent on a channel before the receiver
+    acknowledges them, which bounds a session to ``window_size`` per
+    round trip on high-latency links.
+    """
+
+    def __init__(
+        self, ciphers=None, macs=None, kex=None, window_size=None, max_packet_size=None
+    ):
+        self.ciphers = algorithms(
+            settings.SSH_CIPHERS if ciphers is None else ciphers,
+            paramiko.Transport._cipher_info,
+            "ciphers",
+        )
+        self.macs = algorithms(
+            settings.SSH_MACS if macs is None else macs,
+            paramiko.Transport._mac_info,
+            "MACs",
+        )
+        self.kex = algorithms(
+            settings.SSH_KEX if kex is None else kex,
+            paramiko.Transport._kex_info,
+            "key exchanges",
+        )
+        self.window_size = window_size or settings.SSH_WINDOW_SIZE
+        self.max_packet_size = max_packet_size or settings.SSH_MAX_PACKET_SIZE
+
+    def create_transport(self, conn, host_keys):
+        transport = paramiko.Transport(
+            conn,
+            default_window_size=self.window_size,
+            default_max_packet_size=self.max_packet_size,
+        )
+        for host_key in host_keys:
+            transport.add_server_key(host_key)
+        security = transport.get_security_options()
+        if self.ciphers:
+            security.ciphers = self.ciphers
+        if self.macs:
+            security.digests = self.macs
+        if self.kex:
+            security.kex = self.kex
+        return transport
+
+
+def create_server_socket(host, port, backlog=BACKLOG):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    return server_socket
+
+
+class SessionServer(object):
+    """Accept SSH connections and serve each one on its own thread."""
+
+    def __init__(self, server_socket, host_keys, max_sessions=None, options=None):
+        self.server_socket = server_socket
+        if isinstance(host_keys, paramiko.PKey):
+            host_keys = [host_keys]
+        self.host_keys = host_keys
+        self.options = options or TransportOptions()
+        self.max_sessions = max_sessions or settings.MAX_SESSIONS
+        self._slots = threading.BoundedSemaphore(self.max_sessions)
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if settings.UPLOAD_MODE == "writeback":
+            start_journal()
+
+    @property
+    def active_sessions(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Accept connections until :meth:`shutdown` is called.
+
+        A session slot is taken before ``accept`` so that, once
+        ``max_sessions`` clients are connected, new ones wait in the
+        listen backlog instead of being accepted and starved.
+        """
+        self.server_socket.settimeout(poll_interval)
+        while not self._stopped.is_set():
+            if not self._slots.acquire(timeout=poll_interval):
+                continue
+            try:
+                conn, addr = self.server_socket.accept()
+            except socket.timeout:
+                self._slots.release()
+                continue
+            except OSError:
+                self._slots.release()
+                if self._stopped.is_set():
+                    break
+                raise
+            conn.settimeout(None)
+            logger.info("Connection from %s:%s", *addr[:2])
+            thread = threading.Thread(
+                target=self._handle_session,
+                args=(conn, addr),
+                name="sftp-session-%s:%s" % addr[:2],
+                daemon=True,
+            )
+            with self._lock:
+                self._sessions.add(thread)
+            thread.start()
+
+    def _handle_session(self, conn, addr):
+        transport = None
+        metrics.sessions_total.inc()
+        metrics.sessions_active.inc()
+        try:
+            transport = self.options.create_transport(conn, self.host_keys)
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, StubSFTPServer
+            )
+            transport.start_server(server=StubServer())
+
+            channel = transport.accept(settings.AUTH_TIMEOUT)
+            if channel is None:
+                logger.warning("No channel opened by %s:%s", *addr[:2])
+                return
+            transport.join()
+        except Exception as e:
+            logger.error("Session %s:%s failed: %s", addr[0], addr[1], e)
+        finally:
+            if transport is not None:
+                transport.close()
+            else:
+                conn.close()
+            with self._lock:
+                self._sessions.discard(threading.current_thread())
+            self._slots.release()
+            metrics.sessions_active.dec()
+            logger.info("Connection from %s:%s closed", *addr[:2])
+
+    def stop(self):
+        """Make :meth:`serve_forever` return, open sessions keep running."""
+        self._stopped.set()
+
+    def shutdown(self, timeout=None):
+        """Stop accepting connections and wait for open sessions to end.
+
+        ``timeout`` bounds the whole drain, not the wait for each session.
+        """
+        self.stop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
+
+        with self._lock:
+            sessions = list(self._sessions)
+        for thread in sessions:
+            thread.join(remaining())
+        stop_journal(remaining())
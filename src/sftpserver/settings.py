@@ -2,3 +2,165 @@ import os
 
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY_ID")
+
+# Maximum number of SSH sessions served at the same time.
+MAX_SESSIONS = int(os.getenv("SFTP_MAX_SESSIONS", "100"))
+# Seconds a connected client has to authenticate and open a channel.
+AUTH_TIMEOUT = int(os.getenv("SFTP_AUTH_TIMEOUT", "60"))
+# Number of pre-forked worker processes, 0 serves from the main process.
+WORKERS = int(os.getenv("SFTP_WORKERS", "0"))
+# Seconds a worker gets to finish its open sessions on shutdown.
+DRAIN_TIMEOUT = int(os.getenv("SFTP_DRAIN_TIMEOUT", "30"))
+# SSH host key files, comma separated; Ed25519 and ECDSA keys make
+# handshakes much cheaper than RSA ones.
+HOST_KEYS = [
+    path.strip() for path in os.getenv("SFTP_HOST_KEYS", "").split(",") if path.strip()
+]
+# Ciphers, MACs and key exchanges offered to SSH clients, comma separated
+# and fastest first; empty offers everything paramiko supports.
+SSH_CIPHERS = os.getenv(
+    "SFTP_SSH_CIPHERS",
+    "aes128-gcm@openssh.com,aes256-gcm@openssh.com,aes128-ctr,aes256-ctr",
+)
+SSH_MACS = os.getenv(
+    "SFTP_SSH_MACS",
+    "hmac-sha2-256-etm@openssh.com,hmac-sha2-512-etm@openssh.com,"
+    "hmac-sha2-256,hmac-sha2-512,hmac-sha1",
+)
+SSH_KEX = os.getenv("SFTP_SSH_KEX", "")
+# Bytes a client may send on a session before waiting for the server to
+# acknowledge them, which caps uploads at SSH_WINDOW_SIZE per round trip,
+# and the largest SSH packet accepted.
+SSH_WINDOW_SIZE = int(os.getenv("SFTP_SSH_WINDOW_SIZE", str(16 * 1024 * 1024)))
+SSH_MAX_PACKET_SIZE = int(os.getenv("SFTP_SSH_MAX_PACKET_SIZE", str(64 * 1024)))
+# Shared S3 connections kept per set of credentials.
+S3_POOL_SIZE = int(os.getenv("S3_POOL_SIZE", "4"))
+# Seconds after which an idle keep-alive socket of the S3 engine is
+# closed instead of reused.
+S3_POOL_MAX_IDLE = int(os.getenv("S3_POOL_MAX_IDLE", "300"))
+# S3 I/O engine.  "async" sends HEAD, LIST, ranged GET, PUT and part
+# uploads from one event loop shared by every session, over at most
+# S3_ENGINE_CONNECTIONS keep-alive connections, retrying failed requests
+# S3_ENGINE_RETRIES times; "boto" makes blocking boto calls instead.
+S3_ENGINE = os.getenv("SFTP_S3_ENGINE", "async")
+S3_ENGINE_CONNECTIONS = int(os.getenv("SFTP_S3_ENGINE_CONNECTIONS", "256"))
+S3_ENGINE_TIMEOUT = float(os.getenv("SFTP_S3_ENGINE_TIMEOUT", "60"))
+S3_ENGINE_RETRIES = int(os.getenv("SFTP_S3_ENGINE_RETRIES", "2"))
+# Object metadata (stat) cache: number of entries and lifetime in seconds
+# of positive and negative ("no such key") entries.
+METADATA_CACHE_SIZE = int(os.getenv("SFTP_METADATA_CACHE_SIZE", "10000"))
+METADATA_CACHE_TTL = float(os.getenv("SFTP_METADATA_CACHE_TTL", "10"))
+METADATA_CACHE_NEGATIVE_TTL = float(os.getenv("SFTP_METADATA_CACHE_NEGATIVE_TTL", "2"))
+# Seconds the attributes returned by a directory listing answer stat.
+LISTING_CACHE_TTL = float(os.getenv("SFTP_LISTING_CACHE_TTL", "5"))
+# "stream" uploads files to S3 with multipart upload while they are being
+# written, "spool" writes them to a local temp file and uploads on close,
+# "writeback" stages them in JOURNAL_DIR and uploads them after close.
+UPLOAD_MODE = os.getenv("SFTP_UPLOAD_MODE", "stream")
+# Write-back journal: directory (kept across restarts), uploader threads,
+# retries of a failed upload before it is moved to JOURNAL_DIR/failed, and
+# whether staged files are fsynced before close returns.  Renames and
+# deletes of files still pending wait up to JOURNAL_SETTLE_TIMEOUT seconds
+# for their uploads and fail with EAGAIN after that.
+JOURNAL_DIR = os.getenv("SFTP_JOURNAL_DIR", "/var/spool/sftpserver")
+JOURNAL_WORKERS = int(os.getenv("SFTP_JOURNAL_WORKERS", "4"))
+JOURNAL_RETRIES = int(os.getenv("SFTP_JOURNAL_RETRIES", "10"))
+JOURNAL_SETTLE_TIMEOUT = float(os.getenv("SFTP_JOURNAL_SETTLE_TIMEOUT", "30"))
+JOURNAL_FSYNC = os.getenv("SFTP_JOURNAL_FSYNC", "1").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# Digests computed while a file is uploaded, comma separated: MD5 is
+# always computed, "sha256" and "crc32c" (needs the crc32c package) can be
+# added.  They are sent to S3 and kept as metadata of the object.
+UPLOAD_CHECKSUMS = [
+    name.strip().lower()
+    for name in os.getenv("SFTP_UPLOAD_CHECKSUMS", "md5").split(",")
+    if name.strip()
+]
+# Compare the ETags S3 returns for uploads with the MD5s of the data sent.
+# Turn it off for buckets encrypted with SSE-KMS, whose ETags are not MD5s.
+VERIFY_ETAGS = os.getenv("SFTP_VERIFY_ETAGS", "1").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# stat of a file sends a HEAD request when needed to report its checksums,
+# instead of answering from the directory listing.
+STAT_CHECKSUMS = os.getenv("SFTP_STAT_CHECKSUMS", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# Size in bytes of each multipart part (at least 5 MiB).
+UPLOAD_PART_SIZE = int(os.getenv("SFTP_UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+# Parts of one file uploaded at the same time.
+UPLOAD_CONCURRENCY = int(os.getenv("SFTP_UPLOAD_CONCURRENCY", "4"))
+# Threads uploading parts for all sessions of the process, when the
+# storage backend cannot do it without blocking.
+UPLOAD_WORKERS = int(os.getenv("SFTP_UPLOAD_WORKERS", "16"))
+# Bytes of out-of-order writes held per file while waiting for the gap
+# before them to be filled.
+WRITE_REORDER_LIMIT = int(os.getenv("SFTP_WRITE_REORDER_LIMIT", str(32 * 1024 * 1024)))
+# Read-ahead window for sequential downloads, in bytes: it starts at
+# READAHEAD_MIN and doubles up to READAHEAD_MAX while reads stay sequential.
+READAHEAD_MIN = int(os.getenv("SFTP_READAHEAD_MIN", str(256 * 1024)))
+READAHEAD_MAX = int(os.getenv("SFTP_READAHEAD_MAX", str(8 * 1024 * 1024)))
+# Objects of at least SEGMENTED_DOWNLOAD_THRESHOLD bytes are downloaded as
+# DOWNLOAD_SEGMENT_SIZE segments, DOWNLOAD_CONCURRENCY of them fetched in
+# parallel per open file (by a pool of DOWNLOAD_WORKERS threads when the
+# storage backend cannot do it without blocking).
+SEGMENTED_DOWNLOAD_THRESHOLD = int(
+    os.getenv("SFTP_SEGMENTED_DOWNLOAD_THRESHOLD", str(32 * 1024 * 1024))
+)
+DOWNLOAD_SEGMENT_SIZE = int(os.getenv("SFTP_DOWNLOAD_SEGMENT_SIZE", str(8 * 1024 * 1024)))
+DOWNLOAD_CONCURRENCY = int(os.getenv("SFTP_DOWNLOAD_CONCURRENCY", "4"))
+DOWNLOAD_WORKERS = int(os.getenv("SFTP_DOWNLOAD_WORKERS", "16"))
+# Chunk cache for hot objects shared by all sessions: chunk size and
+# memory budget in bytes (0 disables it), plus an optional on-disk tier.
+CHUNK_SIZE = int(os.getenv("SFTP_CHUNK_SIZE", str(1024 * 1024)))
+CHUNK_CACHE_SIZE = int(os.getenv("SFTP_CHUNK_CACHE_SIZE", str(256 * 1024 * 1024)))
+CHUNK_CACHE_DIR = os.getenv("SFTP_CHUNK_CACHE_DIR", "")
+CHUNK_CACHE_DISK_SIZE = int(
+    os.getenv("SFTP_CHUNK_CACHE_DISK_SIZE", str(4 * 1024 * 1024 * 1024))
+)
+# Keys requested per LIST page when listing a directory (S3 caps it at 1000).
+LISTING_PAGE_SIZE = int(os.getenv("SFTP_LISTING_PAGE_SIZE", "1000"))
+# Prometheus metrics endpoint; METRICS_PORT 0 disables it.  Pre-forked
+# workers listen on METRICS_PORT + their worker index.
+METRICS_HOST = os.getenv("SFTP_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("SFTP_METRICS_PORT", "0"))
+# S3-compatible endpoint to use instead of AWS (MinIO, a local stand-in,
+# ...), addressed path-style.  S3_PORT 0 uses the scheme's default port.
+S3_HOST = os.getenv("S3_HOST", "")
+S3_PORT = int(os.getenv("S3_PORT", "0"))
+S3_SECURE = os.getenv("S3_SECURE", "1").lower() in ("1", "true", "yes", "on")
+# Storage backend: "s3", "memory" (process-local, for tests and
+# benchmarks) or "local", a directory tree under STORAGE_ROOT.
+STORAGE_BACKEND = os.getenv("SFTP_STORAGE", "s3")
+STORAGE_ROOT = os.getenv("SFTP_STORAGE_ROOT", "")
+# Server-side copies (rename): objects above MULTIPART_COPY_THRESHOLD, at
+# most 5 GiB on S3, are copied as COPY_PART_SIZE parts.  COPY_CONCURRENCY
+# parts, or keys of a renamed directory, are copied in parallel per
+# rename by a pool of COPY_WORKERS threads.
+MULTIPART_COPY_THRESHOLD = int(
+    os.getenv("SFTP_MULTIPART_COPY_THRESHOLD", str(5 * 1024 ** 3))
+)
+COPY_PART_SIZE = int(os.getenv("SFTP_COPY_PART_SIZE", str(512 * 1024 * 1024)))
+COPY_CONCURRENCY = int(os.getenv("SFTP_COPY_CONCURRENCY", "8"))
+COPY_WORKERS = int(os.getenv("SFTP_COPY_WORKERS", "32"))
+# rmdir of a directory with keys below it deletes all of them, with
+# DeleteObjects requests of up to 1000 keys, instead of only its marker.
+RECURSIVE_RMDIR = os.getenv("SFTP_RECURSIVE_RMDIR", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# Batch deletes in flight per operation, and threads shared by all of them.
+DELETE_CONCURRENCY = int(os.getenv("SFTP_DELETE_CONCURRENCY", "4"))
+DELETE_WORKERS = int(os.getenv("SFTP_DELETE_WORKERS", "16"))
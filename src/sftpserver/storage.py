@@ -0,0 +1,406 @@
+"""
+Storage backend interface.
+
+The SFTP layer only talks to a :class:`StorageBackend`: S3 through
+:class:`~sftpserver.s3_operation.S3Operation`, or, for tests, benchmarks
+and fast local tiers, :class:`~sftpserver.memory_backend.MemoryBackend`
+and :class:`~sftpserver.local_backend.LocalBackend`.  A backend only has
+to implement the object store primitives (list, head, ranged get, put,
+multipart, copy, delete); the metadata caching and directory logic
+built on them is shared.
+
+Backends report failures as ``OSError`` with an errno: ``ENOENT`` for a
+missing bucket or key, ``ESTALE`` when an object no longer matches the
+expected ETag, ``ENOTEMPTY`` for a bucket that cannot be deleted and
+``EIO`` for anything else.
+"""
+
+import abc
+import errno
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from helper.debug import function_debuger
+
+from . import metrics, settings
+from .cache import MISSING, TTLCache
+
+FILE, DIRECTORY = "file", "dir"
+
+# ``checksums`` is ``{algorithm: hex digest}`` from the object's metadata,
+# or None when it was not looked up (listings do not return metadata).
+ObjectInfo = namedtuple(
+    "ObjectInfo", "name size mtime etag kind checksums", defaults=(None,)
+)
+
+# One page of a listing; ``next_marker`` is None on the last page.
+ListPage = namedtuple("ListPage", "entries next_marker")
+
+# Threads running the blocking backend calls started with ``submit_*`` by
+# backends that cannot send requests without blocking.
+upload_executor = ThreadPoolExecutor(
+    max_workers=settings.UPLOAD_WORKERS, thread_name_prefix="s3-upload"
+)
+download_executor = ThreadPoolExecutor(
+    max_workers=settings.DOWNLOAD_WORKERS, thread_name_prefix="s3-download"
+)
+
+# Entries of the single LIST request :meth:`StorageBackend.resolve` makes.
+RESOLVE_PAGE_SIZE = 100
+
+# (bucket name, key name) -> ObjectInfo, or None for keys known missing.
+metadata_cache = TTLCache(settings.METADATA_CACHE_SIZE, settings.METADATA_CACHE_TTL)
+
+metrics.CallbackGauge(
+    "sftp_metadata_cache_hits_total",
+    "Metadata lookups answered from the cache.",
+    lambda: metadata_cache.hits,
+    kind="counter",
+)
+metrics.CallbackGauge(
+    "sftp_metadata_cache_misses_total",
+    "Metadata lookups that went to the storage backend.",
+    lambda: metadata_cache.misses,
+    kind="counter",
+)
+
+
+def no_such_file(name=None):
+    return OSError(errno.ENOENT, "No such file or directory", name)
+
+
+class StorageBackend(abc.ABC):
+    """Object store primitives plus the cached lookups built on them."""
+
+    # Whether the ETags of uploads are the MD5 of their data (or, for
+    # multipart uploads, of their parts' MD5s), as on S3.
+    md5_etags = True
+
+    # -- primitives ---------------------------------------------------------
+
+    @abc.abstractmethod
+    def list_buckets(self):
+        """Names of all buckets."""
+
+    @abc.abstractmethod
+    def bucket_exists(self, bucket_name):
+        pass
+
+    @abc.abstractmethod
+    def create_bucket(self, bucket_name):
+        pass
+
+    @abc.abstractmethod
+    def delete_bucket(self, bucket_name):
+        """Delete an empty bucket, ``ENOTEMPTY`` otherwise."""
+
+    @abc.abstractmethod
+    def head(self, bucket_name, key_name):
+        """``ObjectInfo`` of a key, or None when it does not exist."""
+
+    @abc.abstractmethod
+    def list(self, bucket_name, prefix="", delimiter="", marker="", max_keys=1000):
+        """One :class:`ListPage` of the keys after ``marker`` under ``prefix``.
+
+        With a ``delimiter`` the keys containing it after ``prefix`` are
+        rolled up into one ``DIRECTORY`` entry per common prefix, as S3
+        does.  Entries are in key order.
+        """
+
+    @abc.abstractmethod
+    def get_range(self, bucket_name, key_name, start, end, etag=None):
+        """Bytes ``[start, end)`` of a key.
+
+        With ``etag`` the request fails with ``ESTALE`` instead of
+        returning data of a newer version of the object.
+        """
+
+    @abc.abstractmethod
+    def put(self, bucket_name, key_name, body, checksums=None):
+        """Store ``body``, bytes or a binary file, and return its ETag.
+
+        ``checksums``, ``{algorithm: hex digest}`` of ``body`` computed
+        by the caller, are verified by the store where it can and kept
+        with the object.
+        """
+
+    @abc.abstractmethod
+    def start_multipart(self, bucket_name, key_name, checksums=None):
+        """Begin a multipart upload and return its id.
+
+        ``checksums`` of the whole object, when known in advance, are kept
+        with it.
+        """
+
+    @abc.abstractmethod
+    def upload_part(self, bucket_name, key_name, upload_id, part_num, data, md5=None):
+        """Store part ``part_num`` (from 1) of an upload, return its ETag.
+
+        ``md5``, the hex digest of ``data`` when the caller has it, saves
+        computing it again.
+        """
+
+    @abc.abstractmethod
+    def complete_multipart(self, bucket_name, key_name, upload_id, etags):
+        """Assemble the parts; ``etags`` maps part numbers to their ETags."""
+
+    @abc.abstractmethod
+    def abort_multipart(self, bucket_name, key_name, upload_id):
+        pass
+
+    @abc.abstractmethod
+    def copy(
+        self, bucket_name, key_name, dest_bucket_name, dest_key_name, size=None
+    ):
+        """Copy a key within the store and return the new ETag.
+
+        No data passes through this process.  ``size``, when the caller
+        knows it, saves looking it up where the copy strategy depends on
+        it.
+        """
+
+    @abc.abstractmethod
+    def delete(self, bucket_name, key_name):
+        """Delete a key; deleting a missing key is not an error."""
+
+    @abc.abstractmethod
+    def delete_many(self, bucket_name, key_names):
+        """Delete up to 1000 keys, return ``{key: error}`` for failures."""
+
+    # -- non-blocking variants ----------------------------------------------
+
+    def submit_get_range(self, bucket_name, key_name, start, end, etag=None):
+        """Start :meth:`get_range`, return a ``concurrent.futures.Future``.
+
+        Backends that can have requests in flight without a thread for
+        each override this; the default runs the call on a thread pool.
+        """
+        return download_executor.submit(
+            self.get_range, bucket_name, key_name, start, end, etag
+        )
+
+    def submit_upload_part(
+        self, bucket_name, key_name, upload_id, part_num, data, md5=None
+    ):
+        """Start :meth:`upload_part`, return a ``Future`` of the part's ETag."""
+        return upload_executor.submit(
+            self.upload_part, bucket_name, key_name, upload_id, part_num, data, md5
+        )
+
+    # -- shared logic -------------------------------------------------------
+
+    @function_debuger
+    def check_bucket(self, bucket_name):
+        """Raise ``ENOENT`` unless the bucket exists."""
+        if not self.bucket_exists(bucket_name):
+            raise no_such_file(bucket_name)
+
+    @function_debuger
+    def head_object(self, bucket_name, key_name, refresh=False):
+        """Return the ``ObjectInfo`` of a key, or None when it does not exist.
+
+        Answers come from ``metadata_cache`` unless ``refresh`` is set.
+        """
+        cache_key = (bucket_name, key_name)
+        info = MISSING if refresh else metadata_cache.get(cache_key)
+        if info is not MISSING:
+            return info
+        info = self.head(bucket_name, key_name)
+        if info is None:
+            metadata_cache.set(cache_key, None, settings.METADATA_CACHE_NEGATIVE_TTL)
+            return None
+        metadata_cache.set(cache_key, info)
+        return info
+
+    @function_debuger
+    def find_directory(self, bucket_name, prefix):
+        """Return an ``ObjectInfo`` for the directory ``prefix`` or None.
+
+        ``prefix`` ends with a separator.  A directory exists when its
+        marker key or any key below it does, which one LIST request with
+        ``max-keys=1`` answers however large the bucket is.
+        """
+        cache_key = (bucket_name, prefix)
+        info = metadata_cache.get(cache_key)
+        if info is not MISSING:
+            return info
+        page = self.list(bucket_name, prefix=prefix, max_keys=1)
+        if not page.entries:
+            metadata_cache.set(cache_key, None, settings.METADATA_CACHE_NEGATIVE_TTL)
+            return None
+        info = ObjectInfo(prefix, 0, 0, "", DIRECTORY)
+        metadata_cache.set(cache_key, info)
+        return info
+
+    @function_debuger
+    def resolve(self, bucket_name, key_name):
+        """Return the ``ObjectInfo`` of the file or directory ``key_name``.
+
+        A file wins over a directory of the same name; None when neither
+        exists.  One LIST of ``key_name`` with a delimiter answers every
+        case: the key itself sorts first, and the directory, marker or
+        implicit, is the common prefix ``key_name/`` after the few names
+        sorting between them (``key_name-1``, ``key_name.txt``).  Only if
+        the page ends before it does a second request decide.
+        """
+        prefix = key_name + "/"
+        info = metadata_cache.get((bucket_name, key_name))
+        if info is not MISSING and info is not None:
+            return info
+        if info is None:
+            directory = metadata_cache.get((bucket_name, prefix))
+            if directory is not MISSING:
+                return directory
+
+        page = self.list(
+            bucket_name, prefix=key_name, delimiter="/", max_keys=RESOLVE_PAGE_SIZE
+        )
+        info = directory = None
+        for entry in page.entries:
+            if entry.name == key_name:
+                info = entry
+            elif entry.name == prefix:
+                directory = ObjectInfo(prefix, 0, 0, "", DIRECTORY)
+        negative_ttl = settings.METADATA_CACHE_NEGATIVE_TTL
+        if info is not None:
+            metadata_cache.set((bucket_name, key_name), info)
+        else:
+            metadata_cache.set((bucket_name, key_name), None, negative_ttl)
+        if (
+            directory is not None
+            or page.next_marker is None
+            or page.entries[-1].name > prefix
+        ):
+            metadata_cache.set(
+                (bucket_name, prefix),
+                directory,
+                None if directory is not None else negative_ttl,
+            )
+        elif info is None:
+            directory = self.find_directory(bucket_name, prefix)
+        return info or directory
+
+    @function_debuger
+    def exists(self, bucket_name, key_name):
+        """Whether a bucket, key or virtual directory exists."""
+        if not self.bucket_exists(bucket_name):
+            return False
+        if not key_name:
+            return True
+        if key_name.endswith("/"):
+            return self.find_directory(bucket_name, key_name) is not None
+        return self.resolve(bucket_name, key_name) is not None
+
+    @function_debuger
+    def current_etag(self, bucket_name, key_name):
+        info = self.head_object(bucket_name, key_name, refresh=True)
+        return info.etag if info is not None else None
+
+    @function_debuger
+    def list_directory(self, bucket_name, prefix=""):
+        """Return an iterator of the ``ObjectInfo`` entries below ``prefix``.
+
+        Entries are fetched one page of ``LISTING_PAGE_SIZE`` keys at a
+        time, as the iterator is consumed, so memory use does not grow
+        with the size of the directory.  The bucket is checked right
+        away and raises ``ENOENT`` if it does not exist.
+        """
+        self.check_bucket(bucket_name)
+        return self._iter_listing(bucket_name, prefix)
+
+    def _iter_listing(self, bucket_name, prefix):
+        marker = ""
+        previous_files = set()
+        floor = None
+        while True:
+            page = self.list(
+                bucket_name,
+                prefix=prefix,
+                delimiter="/",
+                marker=marker,
+                max_keys=settings.LISTING_PAGE_SIZE,
+            )
+            infos = page.entries
+            files = set(info.name for info in infos if info.kind == FILE)
+            self.prime_listing(bucket_name, infos, previous_files | files, floor)
+            for info in infos:
+                yield info
+            if page.next_marker is None or not infos:
+                return
+            marker = page.next_marker
+            previous_files = files
+            floor = infos[0].name
+
+    @function_debuger
+    def prime_listing(self, bucket_name, infos, files=None, floor=None):
+        """Remember the entries of a directory listing for a short while.
+
+        Clients usually stat every name right after listing a directory;
+        those stats are then answered without another request.  A
+        sub-directory ``d/`` also tells us that there is no key ``d``
+        unless the listing returned one: ``files`` holds the file names
+        listed from ``floor`` on, names before ``floor`` are unknown.
+        """
+        ttl = settings.LISTING_CACHE_TTL
+        if files is None:
+            files = set(info.name for info in infos if info.kind == FILE)
+        for info in infos:
+            metadata_cache.set((bucket_name, info.name), info, ttl)
+        for info in infos:
+            stem = info.name[:-1]
+            if info.kind != DIRECTORY or stem in files:
+                continue
+            if floor is None or stem >= floor:
+                metadata_cache.set((bucket_name, stem), None, ttl)
+
+    @function_debuger
+    def invalidate_object(self, bucket_name, *key_names):
+        metadata_cache.invalidate(*((bucket_name, name) for name in key_names))
+
+
+def paginate(names, prefix, delimiter, marker, max_keys):
+    """Apply S3 listing rules to key ``names`` in sorted order.
+
+    Yields ``(name, is_prefix)`` for at most ``max_keys`` entries, then
+    ``(None, next_marker)`` if the listing was cut short.  Used by the
+    backends that do not have a server doing it for them.
+    """
+    count = 0
+    last_prefix = None
+    previous = marker
+    for name in names:
+        if not name.startswith(prefix) or name <= marker:
+            continue
+        is_prefix = False
+        if delimiter:
+            index = name.find(delimiter, len(prefix))
+            if index >= 0:
+                name = name[: index + len(delimiter)]
+                if name == last_prefix or name <= marker:
+                    continue
+                last_prefix = name
+                is_prefix = True
+        if count == max_keys:
+            yield None, previous
+            return
+        count += 1
+        previous = name
+        yield name, is_prefix
+
+
+def open_backend(key, secret, kind=None):
+    """The storage backend configured by ``SFTP_STORAGE`` for a session."""
+    kind = kind or settings.STORAGE_BACKEND
+    if kind == "s3":
+        from .s3_operation import S3Operation
+
+        return S3Operation(key, secret)
+    if kind == "memory":
+        from .memory_backend import MemoryBackend
+
+        return MemoryBackend()
+    if kind == "local":
+        from .local_backend import LocalBackend
+
+        return LocalBackend(settings.STORAGE_ROOT)
+    raise ValueError("Unknown storage backend %r" % kind)
@@ -20,6 +20,8 @@
 A stub SFTP server for loopback SFTP testing.
 """
 
+import errno
+import functools
 import io
 import os
 import tempfile
@@ -29,8 +31,6 @@ from datetime import datetime
 from importlib.resources import path
 from typing import Any
 
-from boto.exception import S3CreateError, S3ResponseError
-from boto.s3.bucketlistresultset import BucketListResultSet
 from helper.debug import function_debuger, function_debuger_with_resule
 from helper.logger import logger
 from paramiko import (
@@ -45,8 +45,20 @@ from paramiko import (
 )
 from paramiko.sftp import SFTP_OK
 
-from . import settings
-from .s3_operation import S3Operation
+from . import metrics, settings
+from .bulk import delete_prefix, report_errors
+from .checksum import Checksums, extended_attributes, verify_etag
+from .download import CachedFetch, RangeReader, SegmentedReader, chunk_cache
+from .journal import (
+    merge_pending,
+    pending_entry,
+    pending_info,
+    settle,
+    start_journal,
+)
+from .rename import move_directory, move_object
+from .storage import DIRECTORY, ObjectInfo, StorageBackend, open_backend
+from .upload import MultipartWriter, ReorderBuffer
 
 FULL_CONTROL_MODE_FLAG = 0o600
 DIR_MODE_FLAG = 0o40600
@@ -55,6 +67,54 @@ cloud_sep = "/"
 ftp_sep = os.sep
 
 
+def stat_attributes(info, filename=None):
+    """``SFTPAttributes`` of an ``ObjectInfo``."""
+    mode = DIR_MODE_FLAG if info.kind == DIRECTORY else FULL_CONTROL_MODE_FLAG
+    attributes = SFTPAttributes.from_stat(
+        os.stat_result(
+            [mode, 0, 0, 0, 0, 0, info.size, info.mtime, info.mtime, info.mtime]
+        ),
+        filename=filename,
+    )
+    attributes.attr = extended_attributes(info.checksums)
+    return attributes
+
+
+class LazyAttributeList(list):
+    """A directory listing produced on demand from an iterator.
+
+    paramiko's folder handles only take ``files[:16]`` for each READDIR
+    reply and keep ``files[16:]``, so entries are pulled from the
+    iterator 16 at a time and never held all at once.
+    """
+
+    def __init__(self, iterable, buffered=()):
+        super(LazyAttributeList, self).__init__(buffered)
+        self._source = iter(iterable)
+
+    def _fill(self, count):
+        while list.__len__(self) < count:
+            try:
+                self.append(next(self._source))
+            except StopIteration:
+                break
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            self._fill(index + 1)
+            return list.__getitem__(self, index)
+        if index.stop is not None or index.step not in (None, 1):
+            self._fill(index.stop)
+            return list.__getitem__(self, index)
+        start = index.start or 0
+        self._fill(start)
+        # The tail shares the iterator rather than wrapping it, which would
+        # nest one more level for every READDIR.
+        return LazyAttributeList(
+            self._source, list.__getitem__(self, slice(start, None))
+        )
+
+
 def asciify(string):
     # Try to convert string to a legible format for non-Unicode clients.
     try:
@@ -105,7 +165,9 @@ class StubSFTPHandle(SFTPHandle):
 
 class S3Handler(SFTPHandle):
     @function_debuger
-    def __init__(self, username, bucket, obj_name, mode, flags, s3: S3Operation):
+    def __init__(
+        self, username, bucket, obj_name, mode, flags, storage: StorageBackend
+    ):
         super(S3Handler, self).__init__(flags)
         self.username = username
         self.bucket = bucket
@@ -115,9 +177,15 @@ class S3Handler(SFTPHandle):
         self.total_size = 0
         self.temp_file_path = None
         self.temp_file = None
-        self.s3 = s3
+        self.checksums = None
+        self.writer = None
+        self.staged = None
+        self.stream = None
+        # The error of a refused write: the upload is discarded on close.
+        self.write_error = None
+        self.storage = storage
         logger.info(
-            "Creating S3Handler(%s,%s,%s,%s)" % (username, bucket, obj_name, mode)
+            "Creating S3Handler(%s,%s,%s,%s)", username, bucket, obj_name, mode
         )
 
         if not all([bucket, obj_name]):
@@ -125,42 +193,130 @@ class S3Handler(SFTPHandle):
             raise IOError(1, "Operation not permitted")
 
         try:
-            self.bucket = self.s3.connection.get_bucket(self.bucket)
+            self.storage.check_bucket(self.bucket)
         except:
             raise IOError(2, "No such file or directory")
 
+        self.reader = None
+        self.bytes_sent = 0
+        self.pending_file = None
+        # A file still waiting in the write-back journal is read from there.
+        self.pending = pending_entry(self.bucket, self.name)
+        if self.pending is not None:
+            self.info = self.pending.info
+            return
         try:
-            self.obj = self.bucket.get_key(self.name)
+            self.info = self.storage.head_object(self.bucket, self.name)
         except:
+            self.info = None
             logger.error("No such file or directory")
 
     @function_debuger
     def init_temp_file(self):
-        self.obj = self.bucket.get_key(self.name)
-        if not self.obj:
-            # key does not exist, create it
-            self.obj = self.bucket.new_key(self.name)
         # create a temporary file
         self.temp_file_path = tempfile.mkstemp()[1]
         self.temp_file = open(self.temp_file_path, "wb")
 
+    @function_debuger
+    def init_writer(self):
+        if settings.UPLOAD_MODE == "stream":
+            self.writer = MultipartWriter(self.storage, self.bucket, self.name)
+            self.stream = ReorderBuffer(self.writer.write)
+        elif settings.UPLOAD_MODE == "writeback":
+            self.staged = start_journal().create(self.bucket, self.name)
+            self.stream = ReorderBuffer(self.staged.write)
+        else:
+            self.init_temp_file()
+            self.checksums = Checksums()
+            self.stream = ReorderBuffer(self.spool)
+
+    def spool(self, data):
+        self.temp_file.write(data)
+        self.checksums.update(data)
+
+    @metrics.timed("write")
     @function_debuger
     def write(self, offset, data):
         if "w" not in self.mode:
             raise OSError(1, "Operation not permitted")
-        if self.temp_file is None:
-            self.init_temp_file()
-        self.temp_file.write(data)
+        if self.write_error is not None:
+            return SFTPServer.convert_errno(self.write_error.errno)
+        if self.stream is None:
+            self.init_writer()
+        try:
+            self.stream.write(offset, data)
+        except OSError as e:
+            logger.error("Write to %s refused: %s" % (self.name, e.strerror))
+            self.write_error = e
+            return SFTPServer.convert_errno(e.errno)
+        metrics.bytes_received_total.inc(len(data))
         return SFTP_OK
 
+    @function_debuger
+    def discard_writes(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+        if self.staged is not None:
+            self.staged.discard()
+            self.staged = None
+        if self.temp_file is not None:
+            self.temp_file.close()
+            os.remove(self.temp_file_path)
+            self.temp_file_path = None
+            self.temp_file = None
+
+    @function_debuger
+    def close_writer(self):
+        writer, self.writer = self.writer, None
+        try:
+            writer.close()
+        except Exception as e:
+            logger.error("Upload of %s failed: %s" % (self.name, e))
+            writer.abort()
+            raise OSError(5, "Upload of %s failed" % self.name)
+        finally:
+            self.storage.invalidate_object(self.bucket, self.name)
+
+    @metrics.timed("close")
     @function_debuger
     def close(self):
-        if "w" not in self.mode:
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.pending_file is not None:
+            self.pending_file.close()
+            self.pending_file = None
+        if "w" not in self.mode or self.stream is None:
+            return
+        stream, self.stream = self.stream, None
+        if self.write_error is not None:
+            logger.error("Upload of %s discarded after a refused write" % self.name)
+            self.discard_writes()
+            raise OSError(errno.EIO, "Upload of %s discarded" % self.name)
+        try:
+            stream.close()
+        except OSError as e:
+            logger.error("Upload of %s discarded: %s" % (self.name, e.strerror))
+            self.discard_writes()
+            raise
+        if self.writer is not None:
+            return self.close_writer()
+        if self.staged is not None:
+            staged, self.staged = self.staged, None
+            staged.commit()
             return
         self.temp_file.close()
+        checksums = self.checksums.hexdigests()
         try:
-            self.obj.set_contents_from_filename(self.temp_file_path)
-        except S3ResponseError as e:
+            with open(self.temp_file_path, "rb") as f:
+                etag = self.storage.put(self.bucket, self.name, f, checksums)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                # Failed uploads and checksum mismatches reach the client.
+                self.storage.invalidate_object(self.bucket, self.name)
+                self.discard_writes()
+                raise
             # Avoid crashing when the "directory" vanished while we were processing it.
             # This is actually due to a server error. It seems to happen after
             # a "rm file" command incorrectly deletes an entire directory. (!!!)
@@ -170,21 +326,85 @@ class S3Handler(SFTPHandle):
             )
             return
 
-        self.obj.close()
+        self.storage.invalidate_object(self.bucket, self.name)
 
         # clean up the temporary file
         os.remove(self.temp_file_path)
         self.temp_file_path = None
         self.temp_file = None
+        verify_etag(self.storage, etag, checksums["md5"], self.name)
 
+    @function_debuger
+    def init_reader(self):
+        if self.info is None:
+            raise OSError(2, "No such file or directory")
+        if self.pending is not None:
+            try:
+                self.pending_file = open(self.pending.data_path, "rb")
+            except FileNotFoundError:
+                # Uploaded in the meantime.
+                self.pending = None
+                self.info = self.storage.head_object(self.bucket, self.name, True)
+                return self.init_reader()
+            fd = self.pending_file.fileno()
+            self.reader = RangeReader(
+                lambda start, end: os.pread(fd, end - start, start), self.info.size
+            )
+            return
+        fetch = functools.partial(
+            self.storage.get_range, self.bucket, self.name, etag=self.info.etag
+        )
+        # Segments go straight to the backend, which may have them all in
+        # flight without a thread each, unless they come through the cache.
+        submit = functools.partial(
+            self.storage.submit_get_range,
+            self.bucket,
+            self.name,
+            etag=self.info.etag,
+        )
+        if chunk_cache.enabled:
+            submit = None
+            fetch = CachedFetch(
+                chunk_cache,
+                fetch,
+                (self.bucket, self.name, self.info.etag),
+                self.info.size,
+                functools.partial(self.storage.current_etag, self.bucket, self.name),
+            )
+        if self.info.size >= settings.SEGMENTED_DOWNLOAD_THRESHOLD:
+            self.reader = SegmentedReader(fetch, self.info.size, submit=submit)
+        else:
+            self.reader = RangeReader(fetch, self.info.size)
+
+    @metrics.timed("read")
     @function_debuger(print_input=True)
     def read(self, offset, length):
         if "r" not in self.mode:
             raise OSError(1, "Operation not permitted")
-
-        # file_stream = io.StringIO()
-        # self.obj.download_fileobj(file_stream)
-        return self.obj.read(length)
+        if self.reader is None:
+            self.init_reader()
+        try:
+            try:
+                data = self.reader.read(offset, length)
+            except OSError as e:
+                if e.errno != errno.ESTALE or self.pending is not None:
+                    raise
+                # Replaced since it was cached: drop the stale entries and,
+                # if nothing of the old version was sent yet, read the new one.
+                self.storage.invalidate_object(self.bucket, self.name)
+                if self.bytes_sent:
+                    raise
+                self.reader.close()
+                self.reader = None
+                self.info = self.storage.head_object(self.bucket, self.name, True)
+                self.init_reader()
+                data = self.reader.read(offset, length)
+        except OSError as e:
+            logger.error("Read of %s failed: %s" % (self.name, e.strerror))
+            return SFTPServer.convert_errno(e.errno)
+        self.bytes_sent += len(data)
+        metrics.bytes_sent_total.inc(len(data))
+        return data
 
     @function_debuger
     def seek(self, *kargs, **kwargs):
@@ -193,11 +413,7 @@ class S3Handler(SFTPHandle):
     @function_debuger
     def stat(self):
         try:
-            return SFTPAttributes.from_stat(
-                os.stat_result(
-                    [FULL_CONTROL_MODE_FLAG, 0, 0, 0, 0, 0, self.obj.size, 0, 0, 0]
-                )
-            )
+            return stat_attributes(self.info)
         except Exception as e:
             logger.exception(e)
             return SFTPServer.convert_errno(-1)
@@ -220,8 +436,12 @@ class StubSFTPServer(SFTPServerInterface):
     ROOT = os.getcwd()
 
     @function_debuger
-    def connect_s3(self, key, secret):
-        self.s3 = S3Operation(key, secret)
+    def session_started(self):
+        self.connect_storage(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
+
+    @function_debuger
+    def connect_storage(self, key, secret):
+        self.storage = open_backend(key, secret)
 
     @function_debuger(print_input=True, print_output=True)
     def parse_fspath(self, path):
@@ -230,7 +450,7 @@ class StubSFTPServer(SFTPServerInterface):
         """
         if path == ".":
             path = "/"
-        logger.info("parse_fspath(%s)" % (path))
+        logger.debug("parse_fspath(%s)", path)
         if not path.startswith(ftp_sep):
             raise ValueError(
                 "parse_fspath: You have to provide a full path, not %s" % path
@@ -257,8 +477,8 @@ class StubSFTPServer(SFTPServerInterface):
 
     @function_debuger(print_input=True, print_output=True)
     def get_list_dir(self, path):
-        """ "Return an iterator object that yields a directory listing
-        in a form suitable for LIST command.
+        """Return an iterator object that yields the ``ObjectInfo`` entries
+        of a directory listing.
         """
         try:
             _, bucket, obj = self.parse_fspath(path)
@@ -266,63 +486,42 @@ class StubSFTPServer(SFTPServerInterface):
             raise OSError(2, "No such file or directory")
 
         if not bucket and not obj:
-            buckets = self.s3.get_all_buckets()
-            logger.info("------ 1 %r", buckets)
-            return buckets
-
-        if bucket and not obj:
-            try:
-                objects = self.s3.connection.get_bucket(bucket_name=bucket).list(
-                    delimiter=cloud_sep
-                )
-            except:
-                raise OSError(2, "No such file or directory")
-            logger.info("------ 2 %r", objects)
-            for obj in objects:
-                logger.debug("------ %r", obj.__dict__)
-            return objects
-            return list(self.format_list_objects(objects))
+            return (
+                ObjectInfo(name, 0, 0, "", DIRECTORY)
+                for name in self.storage.list_buckets()
+            )
 
-        if bucket and obj:
+        if obj:
             # This is a key, which is not supported literally as a directory.
             # Try interpreting as a hierarchical key:
             obj += cloud_sep  # Because S3 add a cloud_sep and the end of the file name
-            try:
-                objects = self.s3.connection.get_bucket(bucket_name=bucket).list(
-                    prefix=obj, delimiter=cloud_sep
-                )
-            except:
-                raise OSError(2, "No such file or directory")
-            logger.info("------ 3 %r", objects)
-            return [i for i in list(objects) if i.name != obj]
-            return list(self.format_list_objects(objects))
+        try:
+            infos = self.storage.list_directory(bucket, obj)
+        except:
+            raise OSError(2, "No such file or directory")
+        return merge_pending(
+            bucket, obj, (info for info in infos if info.name != obj)
+        )
 
+    @metrics.timed("list_folder")
     @function_debuger(print_input=True, print_output=True)
     def list_folder(self, path):
-        logger.info("--------------- path %r", path)
+        logger.info("list_folder(%s)" % path)
         if path == "/":
-            buckets = self.s3.get_all_buckets()
-            logger.info("buckets %r", buckets[0].__dict__)
+            buckets = self.storage.list_buckets()
             return [
                 SFTPAttributes.from_stat(
                     os.stat_result([DIR_MODE_FLAG, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
-                    filename=bucket.name,
+                    filename=bucket,
                 )
                 for bucket in buckets
             ]
-        else:
-            buckets = self.get_list_dir(path)
-        st_size = 0
-        return [
-            SFTPAttributes.from_stat(
-                os.stat_result(
-                    [FULL_CONTROL_MODE_FLAG, 0, 0, 0, 0, 0, st_size, 0, 0, 0]
-                ),
-                filename=self.get_basename(bucket.name),
-            )
-            for bucket in buckets
-        ]
+        return LazyAttributeList(
+            stat_attributes(info, filename=self.get_basename(info.name))
+            for info in self.get_list_dir(path)
+        )
 
+    @metrics.timed("lexists")
     @function_debuger
     def lexists(self, path):
         try:
@@ -333,25 +532,19 @@ class StubSFTPServer(SFTPServerInterface):
         if not bucket_name and not key_name:
             return True  # root
 
-        if bucket_name and not key_name:
-            try:
-                bucket = self.s3.connection.get_bucket(bucket_name)
-                objects = bucket.list()
-            except:
-                raise OSError(2, "No such file or directory")
-            return path in objects
-
-        if bucket_name and key_name:
-            bucket = self.s3.connection.get_bucket(bucket_name)
-            return not (not bucket.get_key(key_name))
+        if key_name and pending_info(bucket_name, key_name) is not None:
+            return True
+        return self.storage.exists(bucket_name, key_name)
 
+    @metrics.timed("stat")
     @function_debuger
     def stat(self, path):
-        self.connect_s3(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
         st_mode = FULL_CONTROL_MODE_FLAG
         _, bucket_name, key_name = self.parse_fspath(path)
 
         st_size = 0
+        st_mtime = 0
+        checksums = None
 
         try:
             if not key_name:  # Bucket
@@ -359,18 +552,26 @@ class StubSFTPServer(SFTPServerInterface):
                 st_mode = st_mode | DIR_MODE_FLAG
 
             else:  # Key
-                bucket = self.s3.connection.get_bucket(bucket_name)
+                self.storage.check_bucket(bucket_name)
                 if key_name[-1] == cloud_sep:  # Virtual directory for hierarchical key.
                     st_mode = st_mode | DIR_MODE_FLAG
                 else:
-                    obj = bucket.get_key(key_name)
-                    # Workaround os.sep crap.
+                    # File, directory marker or implicit directory.
+                    obj = pending_info(bucket_name, key_name)
                     if obj is None:
-                        obj = bucket.get_key(key_name.replace(cloud_sep, os.sep))
-                    if obj is None:
-                        # Key is a folder will end with a cloud_sep
+                        obj = self.storage.resolve(bucket_name, key_name)
+                    if (
+                        settings.STAT_CHECKSUMS
+                        and obj is not None
+                        and obj.kind != DIRECTORY
+                        and obj.checksums is None
+                    ):
+                        # Listings carry no metadata, HEAD has the checksums.
+                        obj = self.storage.head_object(
+                            bucket_name, key_name, refresh=True
+                        ) or obj
+                    if obj is not None and obj.kind == DIRECTORY:
                         st_mode = st_mode | DIR_MODE_FLAG
-                        obj = bucket.get_key(key_name + cloud_sep)
                     if obj is None:
                         logger.error(
                             "Cannot find object for path %s , key %s in bucket %s "
@@ -378,12 +579,16 @@ class StubSFTPServer(SFTPServerInterface):
                         )
                         raise OSError(2, "No such file or directory")
                     st_size = obj.size
+                    st_mtime = obj.mtime
+                    checksums = obj.checksums
 
-            return SFTPAttributes.from_stat(
+            attributes = SFTPAttributes.from_stat(
                 os.stat_result(
-                    [st_mode, 0, 0, 0, 0, 0, st_size, 0, 0, 0]
-                )  # FIXME more stats (mtime)
+                    [st_mode, 0, 0, 0, 0, 0, st_size, st_mtime, st_mtime, st_mtime]
+                )
             )
+            attributes.attr = extended_attributes(checksums)
+            return attributes
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
         except Exception as e:
@@ -401,13 +606,15 @@ class StubSFTPServer(SFTPServerInterface):
     lstat = stat
     exists = lexists
 
+    @metrics.timed("open")
     @function_debuger
     def open(self, path, flags, attr):
         # mode = getattr(attr, "st_mode", "erw")
         mode = "wr"
         username, bucket, obj = self.parse_fspath(path)
-        return S3Handler(username, bucket, obj, mode, 0o666, s3=self.s3)
+        return S3Handler(username, bucket, obj, mode, 0o666, storage=self.storage)
 
+    @metrics.timed("remove")
     @function_debuger
     def remove(self, path):
         _, bucket, name = self.parse_fspath(path)
@@ -415,9 +622,10 @@ class StubSFTPServer(SFTPServerInterface):
         if not name:
             raise OSError(13, "Operation not permitted")
 
+        settle(bucket, name, discard=True)
         try:
-            bucket = self.s3.connection.get_bucket(bucket)
-            bucket.delete_key(name)
+            self.storage.delete(bucket, name)
+            self.storage.invalidate_object(bucket, name)
         except:
             raise OSError(2, "No such file or directory")
         return not name
@@ -426,22 +634,23 @@ class StubSFTPServer(SFTPServerInterface):
     def isdir(self, path):
         return path.endswith(cloud_sep)
 
+    @metrics.timed("mkdir")
     @function_debuger
     def mkdir(self, path, attr):
         _, bucket_name, obj_name = self.parse_fspath(path)
         try:
             if obj_name:
-                bucket = self.s3.connection.get_bucket(bucket_name)
                 if not obj_name.endswith(cloud_sep):
                     obj_name += cloud_sep
-                new_folder = bucket.new_key(obj_name)
-                new_folder.set_contents_from_string("")
+                self.storage.put(bucket_name, obj_name, b"")
+                self.storage.invalidate_object(bucket_name, obj_name, obj_name[:-1])
             else:
-                self.s3.connection.create_bucket(bucket_name)
+                self.storage.create_bucket(bucket_name)
         except (ValueError):
             raise OSError(2, "No such file or directory")
         return SFTP_OK
 
+    @metrics.timed("rmdir")
     @function_debuger
     def rmdir(self, path):
         _, bucket_name, obj_name = self.parse_fspath(path)
@@ -449,38 +658,101 @@ class StubSFTPServer(SFTPServerInterface):
         # If the user requests 'rmdir' of a file, refuse that.
         # This is important to avoid falling through to delete an entire bucket!
         try:
-            if obj_name:
-                bucket = self.s3.connection.get_bucket(bucket_name)
-                if not obj_name.endswith(cloud_sep):
-                    obj_name += cloud_sep
-                objects = self.s3.connection.get_bucket(bucket_name=bucket).list(
-                    prefix=obj_name, delimiter=cloud_sep
-                )
-                obj = None
-                for o in objects:
-                    if o.name == obj_name:
-                        obj = o
-                        break
-
-                if obj is None:
-                    raise OSError(2, "No such file or directory")
-                else:
-                    obj.delete()
-            else:
-                try:
-                    bucket = self.s3.connection.get_bucket(bucket)
-                except:
-                    raise OSError(2, "No such file or directory")
-
-                try:
-                    self.s3.connection.delete_bucket(bucket)
-                except:
-                    raise OSError(39, "Directory not empty: '%s'" % bucket)
-        except Exception:
-            raise OSError(39, "Directory not empty: '%s'" % bucket)
+            self.storage.check_bucket(bucket_name)
+        except:
+            raise OSError(2, "No such file or directory")
+
+        if obj_name and settings.RECURSIVE_RMDIR:
+            prefix = obj_name.rstrip(cloud_sep) + cloud_sep
+            settle(bucket_name, prefix=prefix, discard=True)
+            self.storage.invalidate_object(bucket_name, prefix)
+            if self.storage.find_directory(bucket_name, prefix) is None:
+                raise OSError(2, "No such file or directory")
+            count, errors = delete_prefix(self.storage, bucket_name, prefix)
+            logger.info("Deleted %d keys below %s", count, path)
+            if errors:
+                report_errors(errors, "rmdir %s" % path)
+        elif obj_name:
+            if not obj_name.endswith(cloud_sep):
+                obj_name += cloud_sep
+            if self.storage.head_object(bucket_name, obj_name, refresh=True) is None:
+                raise OSError(2, "No such file or directory")
+            self.storage.delete(bucket_name, obj_name)
+            self.storage.invalidate_object(bucket_name, obj_name, obj_name[:-1])
+        else:
+            try:
+                self.storage.delete_bucket(bucket_name)
+            except:
+                raise OSError(39, "Directory not empty: '%s'" % bucket_name)
 
         return SFTP_OK
 
+    @metrics.timed("rename")
+    @function_debuger
+    def rename(self, oldpath, newpath):
+        """Rename, failing if ``newpath`` exists (SFTP ``RENAME``)."""
+        try:
+            self.move(oldpath, newpath, overwrite=False)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    @metrics.timed("rename")
+    @function_debuger
+    def posix_rename(self, oldpath, newpath):
+        """Rename, replacing a file at ``newpath`` (posix-rename@openssh.com)."""
+        try:
+            self.move(oldpath, newpath, overwrite=True)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    @function_debuger
+    def move(self, oldpath, newpath, overwrite):
+        """Move a key or a virtual directory with server-side copies."""
+        _, bucket_name, key_name = self.parse_fspath(oldpath)
+        _, dest_bucket_name, dest_key_name = self.parse_fspath(newpath)
+        key_name = key_name.rstrip(cloud_sep)
+        dest_key_name = dest_key_name.rstrip(cloud_sep)
+        if not key_name or not dest_key_name:
+            raise OSError(errno.EPERM, "Buckets cannot be renamed")
+        if (bucket_name, key_name) == (dest_bucket_name, dest_key_name):
+            return
+        self.storage.check_bucket(dest_bucket_name)
+        # Renaming files still in the write-back journal waits for them.
+        settle(bucket_name, key_name, prefix=key_name + cloud_sep)
+        settle(dest_bucket_name, dest_key_name)
+        dest_info = self.storage.resolve(dest_bucket_name, dest_key_name)
+        dest_prefix = dest_key_name + cloud_sep
+
+        info = self.storage.resolve(bucket_name, key_name)
+        if info is not None and info.kind != DIRECTORY:
+            if dest_info is not None and dest_info.kind == DIRECTORY:
+                raise OSError(errno.EISDIR, "Is a directory", newpath)
+            if dest_info is not None and not overwrite:
+                raise OSError(errno.EEXIST, "File exists", newpath)
+            move_object(
+                self.storage,
+                bucket_name,
+                key_name,
+                dest_bucket_name,
+                dest_key_name,
+                info.size,
+            )
+            return
+
+        prefix = key_name + cloud_sep
+        if info is None:
+            raise OSError(errno.ENOENT, "No such file or directory", oldpath)
+        if dest_info is not None:
+            raise OSError(errno.EEXIST, "File exists", newpath)
+        if bucket_name == dest_bucket_name and dest_prefix.startswith(prefix):
+            raise OSError(errno.EINVAL, "Cannot move a directory into itself")
+        count = move_directory(
+            self.storage, bucket_name, prefix, dest_bucket_name, dest_prefix
+        )
+        logger.info("Moved %d keys from %s to %s", count, oldpath, newpath)
+
     # @function_debuger
     # def open(self, path, flags, attr):
     #     path = self._realpath(path)
@@ -531,16 +803,6 @@ class StubSFTPServer(SFTPServerInterface):
     #         return SFTPServer.convert_errno(e.errno)
     #     return SFTP_OK
 
-    # @function_debuger
-    # def rename(self, oldpath, newpath):
-    #     oldpath = self._realpath(oldpath)
-    #     newpath = self._realpath(newpath)
-    #     try:
-    #         os.rename(oldpath, newpath)
-    #     except OSError as e:
-    #         return SFTPServer.convert_errno(e.errno)
-    #     return SFTP_OK
-
     # @function_debuger
     # def mkdir(self, path, attr):
     #     path = self._realpath(path)
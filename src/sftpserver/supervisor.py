@@ -0,0 +1,149 @@
+"""
+Pre-fork supervisor.
+
+The listening socket is created once in the supervisor and inherited by
+``workers`` forked processes, each running its own :class:`SessionServer`.
+Crashed workers are restarted; on SIGTERM/SIGINT every worker stops
+accepting, finishes its open sessions and exits.  Each worker keeps
+its slot number across restarts, which gives it a stable metrics port.
+"""
+
+import os
+import signal
+import time
+
+from helper.logger import logger
+
+from . import metrics, settings
+from .server import SessionServer
+
+# A worker dying sooner than this after its start is considered a crash
+# loop, restarts are then delayed to avoid spinning.
+MIN_WORKER_LIFETIME = 1.0
+
+
+def run_worker(
+    server_socket, host_keys, max_sessions=None, metrics_address=None, options=None
+):
+    """Serve sessions in the current process until SIGTERM/SIGINT."""
+    if metrics_address is not None:
+        metrics.start_metrics_server(*metrics_address)
+    server = SessionServer(
+        server_socket, host_keys, max_sessions=max_sessions, options=options
+    )
+
+    def stop(signum, frame):
+        logger.info("Worker %d draining", os.getpid())
+        server.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    server.shutdown(settings.DRAIN_TIMEOUT)
+
+
+class Supervisor(object):
+    """Keep ``workers`` worker processes running on a shared socket."""
+
+    def __init__(
+        self,
+        server_socket,
+        host_keys,
+        workers,
+        max_sessions=None,
+        metrics_address=None,
+        options=None,
+    ):
+        self.server_socket = server_socket
+        self.host_keys = host_keys
+        self.workers = workers
+        self.max_sessions = max_sessions
+        self.metrics_address = metrics_address
+        self.options = options
+        self._children = {}
+        self._stopping = False
+
+    def _spawn(self, slot):
+        metrics_address = None
+        if self.metrics_address is not None:
+            host, port = self.metrics_address
+            metrics_address = (host, port + slot)
+        pid = os.fork()
+        if pid == 0:
+            # Until run_worker installs its own handlers, a signal must not
+            # run the supervisor's, which would stop this worker's siblings.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(
+                    self.server_socket,
+                    self.host_keys,
+                    self.max_sessions,
+                    metrics_address,
+                    self.options,
+                )
+            except BaseException as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        self._children[pid] = (time.time(), slot)
+        logger.info("Started worker %d", pid)
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        logger.info("Stopping %d workers", len(self._children))
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while not self._stopping:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            child = self._children.pop(pid, None)
+            if child is None or self._stopping:
+                continue
+            started, slot = child
+            logger.error(
+                "Worker %d exited with status %d, restarting",
+                pid,
+                os.waitstatus_to_exitcode(status),
+            )
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self._spawn(slot)
+
+        self._drain()
+
+    def _drain(self):
+        deadline = time.time() + settings.DRAIN_TIMEOUT
+        while self._children and time.time() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self._children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in self._children:
+            logger.warning("Worker %d did not drain in time, killing it", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self._children.clear()
@@ -0,0 +1,217 @@
+"""
+Streaming uploads.
+
+``ReorderBuffer`` turns the offset-addressed writes of pipelining SFTP
+clients back into a contiguous stream.  ``MultipartWriter`` cuts that
+stream into fixed-size parts and uploads them with a multipart upload
+while the client is still sending, so an upload is durable shortly after
+the last write instead of after a second full pass over a local temp
+file.  The data is checksummed on its way through, and the ETags S3
+returns are checked against those checksums.
+"""
+
+import errno
+import hashlib
+import threading
+
+from helper.debug import function_debuger
+from helper.logger import logger
+
+from . import metrics, settings
+from .checksum import Checksums, multipart_etag, verify_etag
+
+# S3 rejects multipart parts, except the last one, smaller than 5 MiB.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class ReorderBuffer(object):
+    """Pass writes to ``sink`` in offset order.
+
+    Writes arriving ahead of the next expected offset are held back, up
+    to ``max_pending`` bytes (``ENOBUFS`` beyond that), until the gap
+    before them is filled.  Objects are written once, front to back:
+    rewriting bytes already passed on, overlapping writes and files left
+    with holes are refused with ``EINVAL``.
+    """
+
+    def __init__(self, sink, max_pending=None):
+        self.sink = sink
+        self.offset = 0
+        self.max_pending = max_pending or settings.WRITE_REORDER_LIMIT
+        self._pending = {}
+        self._pending_size = 0
+
+    def write(self, offset, data):
+        end = offset + len(data)
+        if offset < self.offset:
+            raise OSError(
+                errno.EINVAL,
+                "Rewriting offset %d is not supported, data up to %d was "
+                "already uploaded" % (offset, self.offset),
+            )
+        for start, chunk in self._pending.items():
+            if start < end and offset < start + len(chunk):
+                raise OSError(
+                    errno.EINVAL,
+                    "Write at offset %d overlaps a pending write at %d"
+                    % (offset, start),
+                )
+        if offset > self.offset:
+            if self._pending_size + len(data) > self.max_pending:
+                raise OSError(
+                    errno.ENOBUFS,
+                    "Write at offset %d is too far ahead of offset %d"
+                    % (offset, self.offset),
+                )
+            self._pending[offset] = data
+            self._pending_size += len(data)
+            return
+        self.sink(data)
+        self.offset = end
+        while self.offset in self._pending:
+            chunk = self._pending.pop(self.offset)
+            self._pending_size -= len(chunk)
+            self.sink(chunk)
+            self.offset += len(chunk)
+
+    def close(self):
+        if self._pending:
+            raise OSError(
+                errno.EINVAL,
+                "Sparse files are not supported, no data was written at "
+                "offset %d" % self.offset,
+            )
+
+
+class MultipartWriter(object):
+    """Upload a key part by part as data is written to it.
+
+    At most ``concurrency`` parts of one writer are in flight; ``write``
+    blocks when they are all busy, which bounds memory to roughly
+    ``(concurrency + 1) * part_size`` per open file.  Files smaller than
+    one part are sent with a single PUT on :meth:`close`, with their
+    :attr:`checksums`; larger ones are verified part by part.
+
+    ``checksums`` of data already complete when the upload starts are
+    stored with multipart uploads too, and :meth:`close` fails with
+    ``EIO`` when the data written does not match them.
+    """
+
+    def __init__(
+        self,
+        storage,
+        bucket_name,
+        key_name,
+        part_size=None,
+        concurrency=None,
+        checksums=None,
+    ):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.part_size = max(part_size or settings.UPLOAD_PART_SIZE, MIN_PART_SIZE)
+        self.size = 0
+        self.checksums = Checksums()
+        self.expected = checksums
+        self._buffer = bytearray()
+        self._upload = None
+        self._futures = []
+        # Hex MD5 of every part submitted, in order.
+        self._md5s = []
+        self._slots = threading.BoundedSemaphore(
+            concurrency or settings.UPLOAD_CONCURRENCY
+        )
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        self.checksums.update(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit(part)
+
+    def _check(self):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _submit(self, part):
+        self._check()
+        if self._upload is None:
+            self._upload = self.storage.start_multipart(
+                self.bucket_name, self.key_name, self.expected
+            )
+        part_num = len(self._futures) + 1
+        md5 = hashlib.md5(part).hexdigest()
+        self._slots.acquire()
+        metrics.upload_parts_in_flight.inc()
+        try:
+            future = self.storage.submit_upload_part(
+                self.bucket_name, self.key_name, self._upload, part_num, part, md5
+            )
+        except BaseException:
+            metrics.upload_parts_in_flight.dec()
+            self._slots.release()
+            raise
+        future.add_done_callback(self._uploaded)
+        self._futures.append(future)
+        self._md5s.append(md5)
+
+    def _uploaded(self, future):
+        metrics.upload_parts_in_flight.dec()
+        self._slots.release()
+
+    def _verify(self):
+        if not self.expected:
+            return
+        checksums = self.checksums.hexdigests()
+        for name, hexdigest in self.expected.items():
+            if checksums.get(name, hexdigest) != hexdigest:
+                raise OSError(
+                    errno.EIO,
+                    "%s of the data does not match its checksum" % name,
+                    self.key_name,
+                )
+
+    @function_debuger
+    def close(self):
+        """Flush the last part and complete the upload."""
+        self._verify()
+        if self._upload is None:
+            checksums = self.checksums.hexdigests()
+            etag = self.storage.put(
+                self.bucket_name, self.key_name, self._buffer, checksums
+            )
+            self._buffer = bytearray()
+            verify_etag(self.storage, etag, checksums["md5"], self.key_name)
+            return etag
+        if self._buffer or not self._futures:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        etags = {
+            part_num: future.result()
+            for part_num, future in enumerate(self._futures, 1)
+        }
+        for part_num, md5 in enumerate(self._md5s, 1):
+            verify_etag(self.storage, etags[part_num], md5, self.key_name)
+        etag = self.storage.complete_multipart(
+            self.bucket_name, self.key_name, self._upload, etags
+        )
+        self._upload = None
+        verify_etag(self.storage, etag, multipart_etag(self._md5s), self.key_name)
+        return etag
+
+    @function_debuger
+    def abort(self):
+        """Give up on the upload and free the parts already stored."""
+        upload, self._upload = self._upload, None
+        self._buffer = bytearray()
+        for future in self._futures:
+            future.cancel()
+        if upload is None:
+            return
+        try:
+            self.storage.abort_multipart(self.bucket_name, self.key_name, upload)
+        except Exception as e:
+            logger.error("Could not abort upload of %s: %s", self.key_name, e)
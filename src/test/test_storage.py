@@ -0,0 +1,206 @@
+import errno
+import os
+import time
+
+import pytest
+from boto.exception import S3ResponseError
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+from sftpserver import journal, settings
+from sftpserver.fake_s3 import FakeS3Server
+from sftpserver.journal import Journal, merge_pending
+from sftpserver.memory_backend import MemoryBackend
+from sftpserver.s3_engine import S3Engine
+from sftpserver.s3_operation import list_page
+from sftpserver.storage import DIRECTORY, FILE, metadata_cache, paginate
+from sftpserver.stub_sftp import LazyAttributeList, S3Handler
+from sftpserver.upload import ReorderBuffer
+
+
+@pytest.fixture
+def storage():
+    MemoryBackend.reset()
+    metadata_cache.clear()
+    backend = MemoryBackend()
+    backend.create_bucket("b")
+    yield backend
+    MemoryBackend.reset()
+    metadata_cache.clear()
+
+
+@pytest.fixture
+def fake_s3():
+    fake = FakeS3Server().start()
+    yield fake
+    fake.stop()
+
+
+def s3_connection(fake):
+    return S3Connection(
+        aws_access_key_id="fake",
+        aws_secret_access_key="fake",
+        host=fake.host,
+        port=fake.port,
+        is_secure=False,
+        calling_format=OrdinaryCallingFormat(),
+    )
+
+
+def listing(storage, prefix, max_keys):
+    names, marker = [], ""
+    while True:
+        page = storage.list("b", prefix, "/", marker, max_keys)
+        names.extend(info.name for info in page.entries)
+        if page.next_marker is None:
+            return names
+        marker = page.next_marker
+
+
+def test_paginate_rolls_up_common_prefixes():
+    names = ["a/1", "a/2", "b", "c/d/e", "c/f"]
+    assert list(paginate(names, "", "/", "", 10)) == [
+        ("a/", True),
+        ("b", False),
+        ("c/", True),
+    ]
+    assert list(paginate(names, "", "/", "", 2)) == [
+        ("a/", True),
+        ("b", False),
+        (None, "b"),
+    ]
+    assert list(paginate(names, "", "/", "a/", 10)) == [("b", False), ("c/", True)]
+
+
+def test_list_pages_cover_every_entry_once(storage):
+    for name in ("d/a", "d/b/1", "d/b/2", "d/c", "d/e/1", "d/f"):
+        storage.put("b", name, b"x")
+    expected = ["d/a", "d/b/", "d/c", "d/e/", "d/f"]
+    for max_keys in (1, 2, 3, 1000):
+        assert listing(storage, "d/", max_keys) == expected
+
+
+def test_resolve_tells_files_and_directories_apart(storage):
+    for name in ("k", "k-1", "k.txt", "k/x", "m/", "n/o/p"):
+        storage.put("b", name, b"x")
+    assert storage.resolve("b", "k").kind == FILE
+    metadata_cache.clear()
+    storage.delete("b", "k")
+    assert storage.resolve("b", "k").name == "k/"
+    assert storage.resolve("b", "m").kind == DIRECTORY
+    assert storage.resolve("b", "n/o").kind == DIRECTORY
+    assert storage.resolve("b", "missing") is None
+
+
+def test_reorder_buffer_passes_writes_in_order():
+    received = []
+    buffer = ReorderBuffer(received.append, max_pending=8)
+    buffer.write(4, b"bbbb")
+    buffer.write(0, b"aaaa")
+    buffer.write(8, b"cc")
+    buffer.close()
+    assert b"".join(received) == b"aaaabbbbcc"
+
+    with pytest.raises(OSError) as e:
+        buffer.write(0, b"x")
+    assert e.value.errno == errno.EINVAL
+    with pytest.raises(OSError) as e:
+        buffer.write(100, b"123456789")
+    assert e.value.errno == errno.ENOBUFS
+    buffer.write(20, b"x")
+    with pytest.raises(OSError) as e:
+        buffer.close()
+    assert e.value.errno == errno.EINVAL
+
+
+def test_refused_write_keeps_the_previous_object(storage):
+    storage.put("b", "k", b"GOOD PREVIOUS VERSION")
+    handle = S3Handler("user", "b", "k", "w", 0, storage=storage)
+    handle.write(0, b"aaaa")
+    handle.write(0, b"xx")
+    handle.write(4, b"bbbb")
+    with pytest.raises(OSError):
+        handle.close()
+    assert storage.get_range("b", "k", 0, 21) == b"GOOD PREVIOUS VERSION"
+
+
+def test_lazy_attribute_list_pages_through_the_source():
+    files = LazyAttributeList(iter(range(100000)))
+    names = []
+    started = time.time()
+    while True:
+        chunk, files = files[:16], files[16:]
+        if len(chunk) == 0:
+            break
+        names.extend(chunk)
+    assert names == list(range(100000))
+    assert time.time() - started < 5
+
+
+def test_merge_pending_keeps_key_order(storage, tmp_path, monkeypatch):
+    # A journal without uploaders keeps what is committed pending.
+    pending = Journal(str(tmp_path), workers=1).start()
+    pending.stop()
+    monkeypatch.setattr(journal, "_journal", pending)
+    for name in ("w/b", "w/sub/y"):
+        staged = pending.create("b", name)
+        staged.write(b"new")
+        staged.commit()
+    for name in ("w/a", "w/b", "w/sub/x", "w/z"):
+        storage.put("b", name, b"x")
+    page = storage.list("b", "w/", "/")
+    merged = list(merge_pending("b", "w/", page.entries))
+    assert [info.name for info in merged] == ["w/a", "w/b", "w/sub/", "w/z"]
+    assert merged[1].size == len(b"new")
+
+
+def test_journal_recovers_uploads_of_a_stopped_process(storage, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "memory")
+    first = Journal(str(tmp_path), workers=1).start()
+    first.stop()
+    staged = first.create("b", "k")
+    staged.write(b"staged data")
+    staged.commit()
+
+    second = Journal(str(tmp_path), workers=1).start()
+    try:
+        deadline = time.time() + 10
+        while second.pending_count and time.time() < deadline:
+            time.sleep(0.01)
+        assert storage.get_range("b", "k", 0, 11) == b"staged data"
+        assert [path.name for path in tmp_path.iterdir()] == [
+            os.path.basename(second.directory)
+        ]
+    finally:
+        second.stop()
+
+
+def test_s3_list_pages_are_in_key_order(fake_s3):
+    for name in ("w/a", "w/sub/x", "w/z"):
+        fake_s3.put_object("b", name, b"x")
+    bucket = s3_connection(fake_s3).get_bucket("b")
+    page = list_page(bucket.get_all_keys(prefix="w/", delimiter="/"))
+    assert [info.name for info in page.entries] == ["w/a", "w/sub/", "w/z"]
+
+
+def test_engine_retries_server_errors(fake_s3):
+    fake_s3.put_object("b", "k", b"data")
+    handler = fake_s3.httpd.RequestHandlerClass
+    original = handler.do_GET
+    failures = [2]
+
+    def flaky_get(self):
+        if failures[0]:
+            failures[0] -= 1
+            return self.send_error(503)
+        return original(self)
+
+    handler.do_GET = flaky_get
+    connection = s3_connection(fake_s3)
+    assert S3Engine(retries=2).submit(connection, "GET", "b", "k").result().body == (
+        b"data"
+    )
+
+    failures[0] = 3
+    with pytest.raises(S3ResponseError) as e:
+        S3Engine(retries=2).submit(connection, "GET", "b", "k").result()
+    assert e.value.status == 503